@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2018 Juan Pedro Bolivar Puente
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the MIT License, as detailed in the LICENSE
+# file located at the root of this source code distribution,
+# or here: <https://github.com/arximboldi/lager/blob/master/LICENSE>
+#
+
+# benchmark.py
+# ------------
+#
+# Times the scripts on synthetic libraries made with synthdb.py.
+#
+# Every script is run as it would be by hand, in the folder of the
+# library, since they all work on `./mixxxdb.sqlite`.  The files they
+# leave behind, including their caches, are removed before each run, so
+# the times are always of a cold start.  The output of every run is kept
+# in the logs/ folder of the library.
+#
+# Results are written as JSON, with the commit they were taken at, and
+# can be compared with the results of another commit:
+#
+#   benchmark.py -n 1000 10000 -o new.json --compare old.json
+#
+# Use --only to run some of the benchmarks, like `--only dedup export`.
+
+import sys
+import json
+import time
+import shutil
+import logging
+import pathlib
+import platform
+import argparse
+import datetime
+import subprocess
+
+import synthdb
+
+logger = logging.getLogger(__name__)
+
+REPO = pathlib.Path(__file__).parent.absolute()
+
+# Files made by the scripts, removed before every run
+OUTPUTS = [
+    'mixxxdb.fixed.sqlite',
+    'mixxxdb.hashes.sqlite',
+    'mixxxdb.dirs.sqlite',
+    'mixxxdb.files.sqlite',
+    'mixxxdb.snapshot.sqlite',
+    'fuzzy.json',
+    'export',
+    'snapshots',
+]
+
+# (name, script, arguments)
+BENCHMARKS = [
+    ('dedup', 'dedup.py', []),
+    ('dedup-content', 'dedup.py', ['--content']),
+    ('dedup-fuzzy', 'dedup.py', ['--fuzzy', 'fuzzy.json']),
+    ('repath', 'repath.py', ['--transforms', 'repath.conf']),
+    ('relocate', 'relocate.py', []),
+    ('forget', 'forget.py', []),
+    ('compact', 'compact.py', []),
+    ('restore-playlists', 'restore-playlists.py', ['backup.sqlite']),
+    ('reimport', 'reimport.py', ['playlists']),
+    ('export', 'export.py', ['--output', 'export']),
+    ('fsindex', 'fsindex.py', ['music', 'moved']),
+    ('snapshots', 'snapshots.py', ['save']),
+]
+
+def commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=REPO, check=True,
+            capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def clean(folder):
+    for name in OUTPUTS:
+        path = folder / name
+        if path.is_dir():
+            shutil.rmtree(path)
+        elif path.exists():
+            path.unlink()
+
+def run(folder, name, script, args):
+    """Run a script in folder, returning the time it took in seconds and
+    its exit code."""
+    clean(folder)
+    log = folder / 'logs' / (name + '.log')
+    log.parent.mkdir(exist_ok=True)
+    with open(log, 'w') as f:
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, str(REPO / script)] + args,
+                                cwd=folder, stdout=f, stderr=f,
+                                stdin=subprocess.DEVNULL)
+        elapsed = time.perf_counter() - start
+    if result.returncode:
+        logger.error("%s failed (%d), see: %s", name, result.returncode, log)
+    return elapsed, result.returncode
+
+def benchmark(work, sizes, names, repeat, seed):
+    results = []
+    for size in sizes:
+        folder = work / str(size)
+        logger.info("generating library of %d tracks", size)
+        # the library of a previous run is not part of the time
+        synthdb.remove(folder)
+        start = time.perf_counter()
+        synthdb.generate(folder, size, seed)
+        results.append({
+            'name': 'synthdb',
+            'tracks': size,
+            'times': [time.perf_counter() - start],
+            'returncode': 0,
+        })
+        for name, script, args in BENCHMARKS:
+            if names and name not in names:
+                continue
+            times = []
+            for _ in range(repeat):
+                elapsed, returncode = run(folder, name, script, args)
+                times.append(elapsed)
+                if returncode:
+                    break
+            logger.info("%s, %d tracks: %.3fs", name, size, min(times))
+            results.append({
+                'name': name,
+                'tracks': size,
+                'command': [script] + args,
+                'times': times,
+                'returncode': returncode,
+            })
+        clean(folder)
+    return results
+
+def compare(results, old_results):
+    """Print the change in the best time of every benchmark."""
+    old_times = {(r['name'], r['tracks']): min(r['times'])
+                 for r in old_results}
+    for r in results:
+        key = (r['name'], r['tracks'])
+        new_time = min(r['times'])
+        if key in old_times:
+            print("%-20s %8d %9.3fs %9.3fs %7.2fx" % (
+                r['name'], r['tracks'], old_times[key], new_time,
+                old_times[key] / new_time if new_time else float('inf')))
+
+def main():
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--tracks', type=int, nargs='+',
+                        default=[1000, 10000],
+                        help="sizes of the libraries to try")
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+                        help="runs of every benchmark, the best one counts")
+    parser.add_argument('-w', '--work', type=pathlib.Path,
+                        default=pathlib.Path('./benchmark'),
+                        help="folder for the generated libraries")
+    parser.add_argument('-o', '--output', type=pathlib.Path, default=None,
+                        help="file for the results (default: stdout)")
+    parser.add_argument('--compare', type=pathlib.Path, default=None,
+                        help="results of another run to compare with")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', nargs='+', default=None, metavar='NAME',
+                        choices=[name for name, _, _ in BENCHMARKS],
+                        help="benchmarks to run (default: all)")
+    args = parser.parse_args()
+
+    results = {
+        'commit': commit(),
+        'date': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': benchmark(args.work.absolute(), args.tracks, args.only,
+                             args.repeat, args.seed),
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results['results'], json.load(f)['results'])
+
+if __name__ == '__main__':
+    main()
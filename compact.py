@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2018 Juan Pedro Bolivar Puente
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the MIT License, as detailed in the LICENSE
+# file located at the root of this source code distribution,
+# or here: <https://github.com/arximboldi/lager/blob/master/LICENSE>
+#
+
+# compact.py
+# ----------
+#
+# Removes rows that nothing refers to anymore, and shrinks the
+# data-base file.
+#
+# The other scripts leave some of those behind: forget.py only removes
+# track locations, repath.py only removes the analysis of the locations
+# it rewrites, and dedup.py moves the cues of duplicates to the track it
+# keeps, so it may end up with the same cue twice.  Removed are:
+#
+#   - library rows without a track location that are not in any
+#     playlist or crate,
+#   - cues and track analysis of tracks that are not in the library,
+#   - cues that are exactly the same as another one of the same track.
+#
+# The data-base is then vacuumed, incrementally if the data-base allows
+# it, or else by writing a compacted copy.
+
+import os
+import sys
+import logging
+import argparse
+
+import mixxxdb
+
+logger = logging.getLogger(__name__)
+
+# (description, table, query for the ids of the rows to remove), in
+# order, so that the rows of the tracks removed first are also removed
+ORPHANS = [
+    ('orphan tracks', 'library', '''
+      SELECT l.id
+      FROM library l
+      LEFT JOIN track_locations tl ON tl.id = l.location
+      LEFT JOIN (SELECT track_id FROM PlaylistTracks
+                 UNION
+                 SELECT track_id FROM crate_tracks) used
+        ON used.track_id = l.id
+      WHERE tl.id IS NULL
+        AND used.track_id IS NULL
+    '''),
+    ('orphan cues', 'cues', '''
+      SELECT c.id
+      FROM cues c
+      LEFT JOIN library l ON l.id = c.track_id
+      WHERE l.id IS NULL
+    '''),
+    ('duplicate cues', 'cues', '''
+      SELECT id
+      FROM (SELECT id, ROW_NUMBER() OVER (
+                         PARTITION BY track_id, type, position, length,
+                                      hotcue, label
+                         ORDER BY id) AS n
+            FROM cues)
+      WHERE n > 1
+    '''),
+    ('orphan analysis', 'track_analysis', '''
+      SELECT ta.id
+      FROM track_analysis ta
+      LEFT JOIN library l ON l.id = ta.track_id
+      WHERE l.id IS NULL
+    '''),
+]
+
+def vacuum(db, path):
+    """Give the free pages of the data-base at path back to the file
+    system.  db is closed afterwards."""
+    mode, = db.execute('PRAGMA auto_vacuum').fetchone()
+    if mode == 2:
+        logger.info("vacuuming incrementally")
+        # execute() only steps the pragma once, freeing a single page,
+        # executescript() runs it to completion
+        db.executescript('PRAGMA incremental_vacuum;')
+        db.close()
+    else:
+        logger.info("vacuuming into a new file")
+        tmp_path = path + '.vacuum'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        db.execute('VACUUM INTO ?', (tmp_path,))
+        db.close()
+        os.replace(tmp_path, path)
+
+def main():
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--no-vacuum', action='store_true',
+                        help="only remove the rows")
+    args = parser.parse_args()
+
+    size = os.path.getsize(mixxxdb.SOURCE)
+    db = mixxxdb.open_copy()
+    for description, table, query in ORPHANS:
+        count = mixxxdb.delete_rows(db, table, query)
+        logger.info("removed %d %s", count, description)
+    if args.no_vacuum:
+        db.close()
+    else:
+        vacuum(db, mixxxdb.TARGET)
+    new_size = os.path.getsize(mixxxdb.TARGET)
+    logger.info("reclaimed %.1f MB (%d -> %d bytes)",
+                (size - new_size) / 2**20, size, new_size)
+
+if __name__ == '__main__':
+    main()
@@ -23,87 +23,356 @@
 # added to the library directly, Mixxx sometimes thinks the newly
 # found files are genuinely new, creating two entries in the
 # data-base for the same path.
+#
+# With --content, it also finds entries for files that have the same
+# contents in different locations, for example when the same file was
+# copied into two folders, and merges them the same way.
+#
+# With --fuzzy REPORT, it looks for entries that are probably the same
+# song under slightly different names, like "Artist feat. X - Title
+# (Original Mix)" and "artist - title", and writes them to a JSON
+# report instead of changing anything.  Set "approved" to true in the
+# groups that really are duplicates, and merge them with --merge REPORT.
 
-import sqlite3
-import shutil
 import os
 import logging
 import sys
 import math
+import argparse
+import collections
+import itertools
+import json
+import re
+import sqlite3
 
-from tqdm import tqdm
+from unidecode import unidecode
+
+import mixxxdb
+
+from filehash import HashCache, stat_files
 
 logger = logging.getLogger(__name__)
 
+# Side-car data-base where the hashes of track files are kept between
+# runs
+HASH_CACHE = './mixxxdb.hashes.sqlite'
+
+# Tracks with a title shared by more than this many others (think
+# "Intro") are not compared, to keep the fuzzy search linear
+FUZZY_MAX_BLOCK = 64
+
+# Fuzzy duplicates must have at least this much in common between the
+# words of their artists, and durations closer than this, in seconds
+FUZZY_MIN_ARTIST = 0.5
+FUZZY_MAX_DURATION = 3
+
+FEATURING_RE = re.compile(r'[\(\[]?\b(feat|ft|featuring)\b.*$')
+NEUTRAL_RE = re.compile(
+    r'[\(\[](original( mix| version)?|album version)[\)\]]')
+NON_WORD_RE = re.compile(r'[^a-z0-9]+')
+
+def create_candidates(db):
+    """Create the table of candidate duplicates.
+
+    Every row maps a library id to the group of duplicates it belongs
+    to.  Tracks in the same group are merged into one by
+    merge_duplicates.
+    """
+    db.execute('''
+      CREATE TEMP TABLE dedup_candidates (
+        id INTEGER PRIMARY KEY,
+        grp NOT NULL
+      )
+    ''')
+
+def find_location_duplicates(db):
+    db.execute('''
+      INSERT INTO dedup_candidates (id, grp)
+      SELECT id, location
+      FROM library
+      WHERE location IN (SELECT location
+                         FROM library
+                         GROUP BY location
+                         HAVING COUNT(*) > 1)
+    ''')
+
+def find_content_duplicates(db, cache, jobs=None):
+    """Group library entries whose files have the same contents.
+
+    Only files that have the same size as some other file are hashed.
+    """
+    paths = [path for path, in db.execute('''
+      SELECT DISTINCT tl.location
+      FROM library l
+      JOIN track_locations tl ON tl.id = l.location
+    ''')]
+    logger.info("checking size of %d files", len(paths))
+    stats = {path: st for path, st in stat_files(paths, jobs).items() if st}
+    sizes = collections.Counter(st.st_size for st in stats.values())
+    stats = {path: st for path, st in stats.items() if sizes[st.st_size] > 1}
+    digests = cache.hash_files(stats, jobs)
+
+    db.execute('''
+      CREATE TEMP TABLE dedup_hashes (
+        location TEXT PRIMARY KEY,
+        digest TEXT NOT NULL
+      )
+    ''')
+    db.executemany('''
+      INSERT INTO dedup_hashes (location, digest) VALUES (?, ?)
+    ''', digests.items())
+    db.execute('''
+      INSERT INTO dedup_candidates (id, grp)
+      SELECT l.id, h.digest
+      FROM library l
+      JOIN track_locations tl ON tl.id = l.location
+      JOIN dedup_hashes h ON h.location = tl.location
+      WHERE h.digest IN (SELECT digest
+                         FROM dedup_hashes
+                         GROUP BY digest
+                         HAVING COUNT(*) > 1)
+    ''')
+    db.execute('''
+      DROP TABLE dedup_hashes
+    ''')
+
+def normalize(text):
+    text = unidecode(text or '').lower()
+    text = NEUTRAL_RE.sub(' ', text)
+    text = FEATURING_RE.sub(' ', text)
+    return NON_WORD_RE.sub(' ', text).strip()
+
+def fuzzy_confidence(a, b):
+    """How likely two library rows are the same song, or None if not.
+
+    Rows are (id, artist words, duration, bpm).  The artists must share
+    enough words and the durations must be close, and the difference in
+    duration and bpm lower the confidence to break ties.
+    """
+    _, artist_a, duration_a, bpm_a = a
+    _, artist_b, duration_b, bpm_b = b
+    union = artist_a | artist_b
+    similarity = len(artist_a & artist_b) / len(union) if union else 1
+    if similarity < FUZZY_MIN_ARTIST:
+        return None
+    confidence = similarity
+    if duration_a and duration_b:
+        delta = abs(duration_a - duration_b)
+        if delta > FUZZY_MAX_DURATION:
+            return None
+        confidence -= 0.1 * delta / FUZZY_MAX_DURATION
+    if bpm_a and bpm_b:
+        delta = min(abs(bpm_a - bpm_b), abs(bpm_a * 2 - bpm_b),
+                    abs(bpm_a - bpm_b * 2))
+        confidence -= 0.1 * min(delta, 1)
+    return confidence
+
+def find_fuzzy_duplicates(db):
+    """Groups of library entries that are probably the same song.
+
+    Tracks are put in blocks by their normalized title, and only tracks
+    in the same block are compared, so this runs in linear time for any
+    realistic library.  Groups are the connected components of the
+    pairs that look like the same song.
+    """
+    blocks = collections.defaultdict(list)
+    rows = {}
+    for row in db.execute('''
+      SELECT l.id, l.artist, l.title, l.duration, l.bpm, tl.location
+      FROM library l
+      LEFT JOIN track_locations tl ON tl.id = l.location
+      WHERE COALESCE(l.mixxx_deleted, 0) = 0
+    '''):
+        tid, artist, title, duration, bpm, location = row
+        key = normalize(title)
+        if not key:
+            continue
+        rows[tid] = row
+        blocks[key].append(
+            (tid, frozenset(normalize(artist).split()), duration, bpm))
+
+    parent = {}
+    def find(x):
+        while parent.get(x, x) != x:
+            x = parent[x]
+        return x
+    confidences = {}
+    skipped = 0
+    for key, block in blocks.items():
+        if len(block) > FUZZY_MAX_BLOCK:
+            skipped += 1
+            continue
+        for a, b in itertools.combinations(block, 2):
+            confidence = fuzzy_confidence(a, b)
+            if confidence is None:
+                continue
+            root_a, root_b = find(a[0]), find(b[0])
+            parent.setdefault(root_a, root_a)
+            parent[root_b] = root_a
+            confidences[root_a] = min(confidence,
+                                      confidences.get(root_a, 1),
+                                      confidences.get(root_b, 1))
+    if skipped:
+        logger.warning("skipped %d titles with too many tracks", skipped)
+
+    groups = collections.defaultdict(list)
+    for tid in parent:
+        groups[find(tid)].append(tid)
+    return [
+        {
+            'approved': False,
+            'confidence': round(confidences[root], 3),
+            'tracks': [
+                dict(zip(['id', 'artist', 'title', 'duration', 'bpm',
+                          'location'], rows[tid]))
+                for tid in sorted(tids)
+            ],
+        }
+        for root, tids in sorted(groups.items(),
+                                 key=lambda item: -confidences[item[0]])
+    ]
+
+def add_approved_duplicates(db, report):
+    for grp, group in enumerate(report):
+        if not group.get('approved'):
+            continue
+        db.executemany('''
+          INSERT OR IGNORE INTO dedup_candidates (id, grp)
+          SELECT id, ? FROM library WHERE id=?
+        ''', [(grp, track['id']) for track in group['tracks']])
+
+def merge_duplicates(db):
+    """Merge every group in dedup_candidates into its best track.
+
+    The best track is the one that is in most playlists, then the one
+    that was played most often.  It gets the highest cuepoint and
+    rating, the bpm that is closest to a multiple of 0.5 and the sum of
+    the play counts of the group, and all references to the others are
+    moved to it.
+    """
+    logger.info("picking best candidates")
+    db.execute('''
+      CREATE TEMP TABLE dedup_map AS
+      SELECT c.id,
+             FIRST_VALUE(c.id) OVER (
+               PARTITION BY c.grp
+               ORDER BY COALESCE(p.n, 0) * 10 + COALESCE(l.timesplayed, 0) DESC,
+                        c.id
+             ) AS best_id
+      FROM dedup_candidates c
+      JOIN library l ON l.id = c.id
+      LEFT JOIN (SELECT track_id, COUNT(*) n
+                 FROM PlaylistTracks
+                 GROUP BY track_id) p ON p.track_id = c.id
+    ''')
+    db.execute('''
+      CREATE INDEX temp.dedup_map_best ON dedup_map (best_id)
+    ''')
+    groups, losers = db.execute('''
+      SELECT COUNT(DISTINCT best_id), COUNT(*) - COUNT(DISTINCT best_id)
+      FROM dedup_map
+    ''').fetchone()
+    logger.info("replacing %d duplicates in %d groups", losers, groups)
+
+    logger.info("merging duplicates")
+    db.execute('''
+      WITH members AS (
+        SELECT m.best_id, l.cuepoint, l.timesplayed, l.rating,
+               FIRST_VALUE(l.bpm) OVER (
+                 PARTITION BY m.best_id
+                 ORDER BY CASE WHEN l.bpm
+                               THEN ABS(l.bpm * 2 - ROUND(l.bpm * 2))
+                               ELSE 2 END,
+                          l.id
+               ) AS bpm
+        FROM dedup_map m
+        JOIN library l ON l.id = m.id
+      ),
+      merged AS (
+        SELECT best_id, MAX(cuepoint) cuepoint, MAX(bpm) bpm,
+               SUM(timesplayed) timesplayed, MAX(rating) rating
+        FROM members
+        GROUP BY best_id
+      )
+      UPDATE library
+      SET cuepoint=merged.cuepoint, bpm=merged.bpm,
+          timesplayed=merged.timesplayed, rating=merged.rating
+      FROM merged
+      WHERE library.id = merged.best_id
+    ''')
+
+    logger.info("moving references")
+    db.execute('''
+      UPDATE cues SET track_id=m.best_id
+      FROM dedup_map m
+      WHERE cues.track_id = m.id AND m.id <> m.best_id
+    ''')
+    db.execute('''
+      UPDATE PlaylistTracks SET track_id=m.best_id
+      FROM dedup_map m
+      WHERE PlaylistTracks.track_id = m.id AND m.id <> m.best_id
+    ''')
+    # a crate may already contain the best track
+    db.execute('''
+      UPDATE OR IGNORE crate_tracks SET track_id=m.best_id
+      FROM dedup_map m
+      WHERE crate_tracks.track_id = m.id AND m.id <> m.best_id
+    ''')
+    db.execute('''
+      DELETE FROM crate_tracks
+      WHERE track_id IN (SELECT id FROM dedup_map WHERE id <> best_id)
+    ''')
+    db.execute('''
+      DELETE FROM library
+      WHERE id IN (SELECT id FROM dedup_map WHERE id <> best_id)
+    ''')
+    db.execute('''
+      DROP TABLE dedup_map
+    ''')
+    db.execute('''
+      DELETE FROM dedup_candidates
+    ''')
+
 def main():
     logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
 
-    logger.info("copying database")
-    shutil.copyfile('./mixxxdb.sqlite',
-                    './mixxxdb.fixed.sqlite')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--content', action='store_true',
+                        help="also merge files with the same contents")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="concurrent file reads")
+    parser.add_argument('--fuzzy', metavar='REPORT',
+                        help="write probable duplicates to REPORT and exit")
+    parser.add_argument('--merge', metavar='REPORT',
+                        help="also merge the approved groups in REPORT")
+    args = parser.parse_args()
+
+    if args.fuzzy:
+        logger.info("finding probable duplicates")
+        report = find_fuzzy_duplicates(mixxxdb.open_readonly())
+        logger.info("found %d groups", len(report))
+        with open(args.fuzzy, 'w') as f:
+            json.dump(report, f, indent=2)
+        return
+
+    db = mixxxdb.open_copy()
+    create_candidates(db)
 
-    db = sqlite3.connect('mixxxdb.fixed.sqlite')
     logger.info("finding duplicates")
-    duplicates = db.execute('''
-      SELECT location, COUNT(*) c
-      FROM library
-      GROUP BY location
-      HAVING c > 1
-    ''')
+    find_location_duplicates(db)
+
+    merge_duplicates(db)
+
+    if args.content:
+        logger.info("finding files with the same contents")
+        find_content_duplicates(db, HashCache(sqlite3.connect(HASH_CACHE)), args.jobs)
+        merge_duplicates(db)
 
-    logger.info("fixing duplicates")
-    for location, c in tqdm(duplicates):
-        # find the duplicates
-        res = list(db.execute('''
-          SELECT id, cuepoint, bpm, timesplayed, rating
-          FROM library
-          WHERE location=?
-        ''', (location,)))
-        get_id          = lambda x: x[0]
-        get_cuepoint    = lambda x: x[1]
-        get_bpm         = lambda x: x[2]
-        get_timesplayed = lambda x: x[3]
-        get_rating      = lambda x: x[4]
-        get_bpm_error   = lambda x: abs(get_bpm(x) * 2 -
-                                        round(get_bpm(x) * 2)) \
-                                    if get_bpm(x) else 2
-        get_in_playlist = lambda x: db.execute('''
-          SELECT COUNT(*) FROM PlaylistTracks
-          WHERE track_id=?
-        ''', (get_id(x),)).fetchone()[0]
-        get_rank        = lambda x: (get_in_playlist(x) * 10 +
-                                     get_timesplayed(x))
-
-        # remove the duplicates
-        best_id = get_id(max(res, key=get_rank))
-        logger.info("replacing other ids with: %s", best_id)
-        for item in res:
-            id = get_id(item)
-            if id == best_id: continue
-            db.execute('''
-              UPDATE cues SET track_id=? WHERE track_id=?
-            ''', (best_id, id))
-            db.execute('''
-              UPDATE PlaylistTracks SET track_id=? WHERE track_id=?
-            ''', (best_id, id))
-            db.execute('''
-              UPDATE crate_tracks SET track_id=? WHERE track_id=?
-            ''', (best_id, id))
-            db.execute('''
-              DELETE FROM library WHERE id=?
-            ''', (id,))
-        # merge the duplicates into the best candidate
-        db.execute('''
-          UPDATE library
-          SET cuepoint=?, bpm=?, timesplayed=?, rating=?
-          WHERE id=?
-        ''', (
-            get_cuepoint(max(res, key=get_cuepoint)),
-            get_bpm(min(res, key=get_bpm_error)),
-            sum(map(get_timesplayed, res)),
-            get_rating(max(res, key=get_rating)),
-            best_id
-        ))
+    if args.merge:
+        logger.info("merging approved duplicates")
+        with open(args.merge) as f:
+            add_approved_duplicates(db, json.load(f))
+        merge_duplicates(db)
 
     logger.info("committing")
     db.commit()
@@ -22,14 +22,61 @@ import unicodedata
 import subprocess
 import ffmpy
 import itertools
+import argparse
+import concurrent.futures
+import collections
+import errno
+import fcntl
+import hashlib
+import threading
+import time
+import json
+import tempfile
 
 from unidecode import unidecode
 
+import mixxxdb
+
+from filehash import HashCache, hash_file, stat_files
+
 logger = logging.getLogger(__name__)
 
 EXPORT_FOLDER=pathlib.Path('/home/raskolnikov/sync/music-export')
 EXPORT_FOLDER_COMPAT=pathlib.Path('/home/raskolnikov/sync/music-export')
 
+# Name of the data-base in the export folder that keeps track of what
+# has been exported already
+MANIFEST_NAME = '.manifest.sqlite'
+
+# ioctl request to share the extents of a file with another one, on file
+# systems that support it (btrfs, XFS...), from <linux/fs.h>
+FICLONE = 0x40049409
+
+# Ways of putting a track in the export folder, in order of preference
+# when picking automatically
+COPY_MODES = ['reflink', 'copy_file_range', 'hardlink', 'symlink', 'copy']
+
+# Errors that mean that a copy mode does not work for a pair of files,
+# in which case we fall back to the next one
+UNSUPPORTED_ERRNOS = {
+    errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL,
+    errno.ENOSYS, errno.EPERM, errno.ENOTTY, errno.EBADF,
+}
+
+# Converted files are kept here, so they can be reused by any export
+# folder instead of running ffmpeg again
+TRANSCODE_CACHE=pathlib.Path('~/.cache/mixxx-db-tools/transcode').expanduser()
+TRANSCODE_CACHE_SIZE=50 * 2**30
+
+# Used by --plan to estimate conversions: how many seconds of audio a
+# single ffmpeg process converts per second, and the size of the output
+TRANSCODE_SPEED = 40
+TRANSCODE_BYTERATE = 320000 // 8
+
+# How many times a failed ffmpeg conversion is attempted again before
+# giving up on that track
+TRANSCODE_RETRIES = 2
+
 class Settings:
     # When compat is True, we will convert files to mp3 for
     # compatibility with older players
@@ -37,13 +84,136 @@ class Settings:
     path = None
     tracks = None
     plists = None
-    def __init__(self, compat = False):
+    # Number of ffmpeg processes that run concurrently in compat mode
+    jobs = None
+    # When playlists_only is True, only playlists that changed are
+    # exported, and tracks that were exported before are not checked
+    playlists_only = False
+    def __init__(self, compat = False, jobs = None, playlists_only = False,
+                 path = None, create = True):
         self.compat = compat
-        self.path = EXPORT_FOLDER_COMPAT if compat else EXPORT_FOLDER
+        self.jobs = jobs or os.cpu_count() or 1
+        self.playlists_only = playlists_only
+        self.path = path or (EXPORT_FOLDER_COMPAT if compat else EXPORT_FOLDER)
         self.tracks = self.path / 'tracks'
         self.plists = self.path / 'playlists'
-        self.tracks.mkdir(parents=True, exist_ok=True)
-        self.plists.mkdir(parents=True, exist_ok=True)
+        if create:
+            self.tracks.mkdir(parents=True, exist_ok=True)
+            self.plists.mkdir(parents=True, exist_ok=True)
+
+
+def open_scratch(path):
+    """A copy in memory of the data-base at path, or an empty one if there
+    is none yet.  Changes to it are lost, so it can be used to look at
+    the data-base without writing anything.
+    """
+    db = sqlite3.connect(':memory:', check_same_thread=False)
+    if os.path.exists(path):
+        src = mixxxdb.open_readonly(path)
+        src.backup(db)
+        src.close()
+    return db
+
+
+class Manifest:
+    """Remembers what every exported track was made from.
+
+    It is stored as a SQLite data-base next to the exported files and
+    maps each track id to the source path, mtime and size, the encoder
+    settings and the destination file.  A track whose source and
+    settings did not change, and whose destination is still in the
+    export folder, does not need to be exported again.  With readonly,
+    the file is never written, or created when it is missing.
+    """
+    def __init__(self, path, present, readonly=False):
+        self.db = open_scratch(path) if readonly else sqlite3.connect(path)
+        self.db.execute('''
+          CREATE TABLE IF NOT EXISTS tracks (
+            id INTEGER PRIMARY KEY,
+            src TEXT NOT NULL,
+            mtime REAL NOT NULL,
+            size INTEGER NOT NULL,
+            encoder TEXT NOT NULL,
+            dst TEXT NOT NULL
+          )
+        ''')
+        self.tracks = {
+            tid: entry for tid, *entry in self.db.execute('''
+              SELECT id, src, mtime, size, encoder, dst FROM tracks
+            ''')
+        }
+        # digests of the sources and copies, see filehash.py, they were
+        # kept in a table of their own before
+        self.db.execute('DROP TABLE IF EXISTS digests')
+        self.hashes = HashCache(self.db)
+        self.db.execute('''
+          CREATE TABLE IF NOT EXISTS playlists (
+            id INTEGER PRIMARY KEY,
+            signature TEXT NOT NULL,
+            digest TEXT NOT NULL,
+            file TEXT NOT NULL
+          )
+        ''')
+        self.playlists = {
+            pid: entry for pid, *entry in self.db.execute('''
+              SELECT id, signature, digest, file FROM playlists
+            ''')
+        }
+        self.present = set(map(str, present))
+
+    def exported(self, tid):
+        """Destination of a track exported before, if it is still there."""
+        entry = self.tracks.get(tid)
+        if entry and entry[-1] in self.present:
+            return pathlib.Path(entry[-1])
+
+    def playlist_unchanged(self, pid, signature):
+        entry = self.playlists.get(pid)
+        return (entry is not None and entry[0] == signature
+                and entry[2] in self.present)
+
+    def playlist_current(self, pid, digest, playlist_file):
+        entry = self.playlists.get(pid)
+        return (entry is not None and entry[1:] == [digest, str(playlist_file)]
+                and entry[2] in self.present)
+
+    def update_playlist(self, pid, signature, digest, playlist_file):
+        self.playlists[pid] = [signature, digest, str(playlist_file)]
+        self.db.execute('''
+          REPLACE INTO playlists (id, signature, digest, file)
+          VALUES (?, ?, ?, ?)
+        ''', (pid, signature, digest, str(playlist_file)))
+
+    def is_current(self, tid, entry):
+        return (self.tracks.get(tid) == list(entry)
+                and entry[-1] in self.present)
+
+    def update(self, tid, entry):
+        self.tracks[tid] = list(entry)
+        self.db.execute('''
+          REPLACE INTO tracks (id, src, mtime, size, encoder, dst)
+          VALUES (?, ?, ?, ?, ?, ?)
+        ''', (tid, *entry))
+
+    def prune(self, tids):
+        stale = [(tid,) for tid in self.tracks if tid not in tids]
+        logger.info("forgetting %d tracks from manifest", len(stale))
+        self.db.executemany('''
+          DELETE FROM tracks WHERE id=?
+        ''', stale)
+        for tid, in stale:
+            del self.tracks[tid]
+
+    def prune_playlists(self, pids):
+        stale = [(pid,) for pid in self.playlists if pid not in pids]
+        self.db.executemany('''
+          DELETE FROM playlists WHERE id=?
+        ''', stale)
+        for pid, in stale:
+            del self.playlists[pid]
+
+    def commit(self):
+        self.db.commit()
 
 
 def sanitize_filename(filename):
@@ -111,120 +281,737 @@ def create_playlist(filenames):
         'Version=2\n'
     ) % num
 
-def export_file(settings, db, tid, file_db):
-    # if we already copied this file, just return the target location
-    if ('track', tid) in file_db:
-        logger.debug("already exported: %s, %s", tid, file_db[('track', tid)])
-        return file_db[('track', tid)]
+def copy_reflink(src_file, dst_file):
+    with open(src_file, 'rb') as src, open(dst_file, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
 
-    # otherwise copy the file and return the resulting filename
-    location, artist, title, bpm = db.execute('''
-      SELECT location, artist, title, bpm
-      FROM library
-      WHERE id=?
-    ''', (tid,)).fetchone()
-    path_str, = db.execute('''
-      SELECT location
-      FROM track_locations
-      WHERE id=?
-    ''', (location,)).fetchone()
+def copy_range(src_file, dst_file):
+    with open(src_file, 'rb') as src, open(dst_file, 'wb') as dst:
+        left = os.fstat(src.fileno()).st_size
+        while left > 0:
+            copied = os.copy_file_range(src.fileno(), dst.fileno(), left)
+            if copied == 0:
+                raise OSError(errno.EIO, "short copy", str(src_file))
+            left -= copied
 
-    logger.debug("exporting track: %s, \"%s\"", tid, path_str)
+def copy_hardlink(src_file, dst_file):
+    os.link(src_file, dst_file)
 
-    # https://github.com/syncthing/syncthing/blob/8f8e8a92858ebb285fada3a09b568a04ec4cd132/lib/protocol/nativemodel_darwin.go#L8
-    # https://stackoverflow.com/questions/3194516/replace-special-characters-with-ascii-equivalent
-    src_file = pathlib.Path(path_str)
-    dst_ext = ".mp3" if settings.compat else src_file.suffix
-    dst_file = settings.tracks / sanitize_filename(unidecode(
+def copy_symlink(src_file, dst_file):
+    os.symlink(os.path.abspath(src_file), dst_file)
+
+COPIERS = {
+    'reflink': copy_reflink,
+    'copy_file_range': copy_range,
+    'hardlink': copy_hardlink,
+    'symlink': copy_symlink,
+    'copy': shutil.copyfile,
+}
+
+class Copier:
+    """Puts files in the export folder with the cheapest method that works.
+
+    In 'auto' mode, it tries reflinks when source and destination are on
+    the same device, then copy_file_range, then a plain copy, and
+    remembers which one worked for every pair of devices.  Other modes
+    are used as requested, falling back to a plain copy when they fail.
+    Links are never picked automatically, because sync tools do not
+    follow symlinks and editing a hardlinked copy would modify the
+    library.
+    """
+    def __init__(self, mode='auto'):
+        self.mode = mode
+        self.modes = {}
+        self.devices = {}
+        self.stats = collections.defaultdict(lambda: [0, 0])
+        self.lock = threading.Lock()
+
+    @property
+    def kind(self):
+        """What the destination files are, as recorded in the manifest."""
+        return self.mode if self.mode in ('hardlink', 'symlink') else 'copy'
+
+    def candidates(self, key):
+        if self.mode != 'auto':
+            modes = [self.mode]
+        elif key in self.modes:
+            modes = [self.modes[key]]
+        else:
+            modes = ['copy_file_range']
+            if key[0] == key[1]:
+                modes.insert(0, 'reflink')
+        # a mode that worked before can still fail for some files, for
+        # example reflinks of NOCOW files
+        if modes[-1] != 'copy':
+            modes.append('copy')
+        return modes
+
+    def device(self, folder):
+        if folder not in self.devices:
+            self.devices[folder] = os.stat(folder).st_dev
+        return self.devices[folder]
+
+    def copy(self, src_file, dst_file, src_stat):
+        key = (src_stat.st_dev, self.device(dst_file.parent))
+        for mode in self.candidates(key):
+            # never write through a link left by a previous export
+            if os.path.lexists(dst_file):
+                os.remove(dst_file)
+            try:
+                COPIERS[mode](src_file, dst_file)
+            except OSError as err:
+                if mode == 'copy' or err.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+                logger.debug("can not %s (%s): %s", mode, err, src_file)
+                continue
+            with self.lock:
+                self.modes.setdefault(key, mode)
+                self.stats[mode][0] += 1
+                self.stats[mode][1] += src_stat.st_size
+            return mode
+        raise RuntimeError("could not copy: %s" % src_file)
+
+    def report(self):
+        for mode, (count, size) in sorted(self.stats.items()):
+            logger.info("%s: %d files, %.1f MB", mode, count, size / 2**20)
+        for (src_dev, dst_dev), mode in self.modes.items():
+            logger.info("device %x -> %x: %s", src_dev, dst_dev, mode)
+
+
+class CopyScheduler:
+    """Copies tracks from all source devices in parallel.
+
+    The playlist walk only queues copies.  They are then grouped by the
+    device of the source file and sorted by inode, which roughly follows
+    the layout on disk, and each device is read by its own thread, so
+    spinning disks do not keep seeking back and forth and several disks
+    are read at the same time.  A copy that fails is reported, and the
+    track left out of the playlists, without stopping the export.
+    """
+    def __init__(self, copier):
+        self.copier = copier
+        self.jobs = collections.defaultdict(list)
+        self.failed = set()
+
+    def submit(self, tid, src_file, dst_file, src_stat, entry):
+        self.jobs[src_stat.st_dev].append(
+            (src_stat.st_ino, tid, src_file, dst_file, src_stat, entry))
+
+    def copy_device(self, jobs):
+        jobs.sort(key=lambda job: job[0])
+        done, failed, size = [], [], 0
+        start = time.monotonic()
+        for ino, tid, src_file, dst_file, src_stat, entry in jobs:
+            try:
+                self.copier.copy(src_file, dst_file, src_stat)
+            except Exception as err:
+                logger.error("error while copying file (%s): %s", err, dst_file)
+                try:
+                    os.remove(dst_file)
+                except OSError:
+                    pass
+                failed.append(tid)
+                continue
+            done.append((tid, entry))
+            size += src_stat.st_size
+        return done, failed, size, time.monotonic() - start
+
+    def run(self, manifest):
+        if not self.jobs:
+            return
+        with concurrent.futures.ThreadPoolExecutor(len(self.jobs)) as executor:
+            results = list(executor.map(self.copy_device, self.jobs.values()))
+        for dev, (done, failed, size, seconds) in zip(self.jobs, results):
+            logger.info("device %x: copied %d files, %.1f MB at %.1f MB/s, "
+                        "%d failed", dev, len(done), size / 2**20,
+                        size / 2**20 / max(seconds, 1e-6), len(failed))
+            for tid, entry in done:
+                manifest.update(tid, entry)
+            self.failed.update(failed)
+        self.jobs.clear()
+
+
+def transcode_args(artist, title):
+    return ('-b:a 320k -ignore_unknown '
+            + ('-metadata artist="' + artist + '" ' if artist else '')
+            + ('-metadata title="' + title +'"' if title else ''))
+
+def transcode_file(src_file, dst_file, args):
+    """Convert src_file into dst_file with ffmpeg, retrying on failure.
+
+    This runs in a worker of the TranscodePool, so the output of
+    ffmpeg is captured instead of interleaved on the terminal, and it
+    never reads from stdin.
+    """
+    # never write through a link left by a previous export
+    if os.path.lexists(dst_file):
+        os.remove(dst_file)
+    for attempt in range(TRANSCODE_RETRIES + 1):
+        try:
+            logger.info("converting: %s", dst_file)
+            ffmpy.FFmpeg(
+                global_options='-nostdin -y',
+                inputs={src_file: '-err_detect ignore_err'}, # add -nv when file breaks
+                outputs={dst_file: args},
+            ).run(stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            return dst_file
+        except Exception as err:
+            try:
+                os.remove(dst_file)
+            except FileNotFoundError:
+                pass
+            if attempt == TRANSCODE_RETRIES:
+                raise
+            logger.warning("retrying conversion (%s): %s", err, dst_file)
+
+
+class TranscodeCache:
+    """Content-addressed store of converted files, shared by all exports.
+
+    Files are keyed by the hash of the source contents and the ffmpeg
+    output arguments, so a track is only converted once no matter how
+    many export folders want it, or how many times the export folder is
+    rebuilt.  When the cache grows over its size limit, the least
+    recently used files are evicted.  It is used from the workers of the
+    TranscodePool, so the index is protected by a lock.  With readonly,
+    the index is only looked at, and nothing is written to the cache.
+    """
+    def __init__(self, path, limit, readonly=False):
+        self.path = path
+        self.limit = limit
+        self.copier = Copier()
+        self.lock = threading.Lock()
+        self.hits = 0
+        if readonly:
+            self.db = open_scratch(path / 'index.sqlite')
+        else:
+            self.path.mkdir(parents=True, exist_ok=True)
+            self.db = sqlite3.connect(path / 'index.sqlite',
+                                      check_same_thread=False)
+        self.db.execute('''
+          CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            used REAL NOT NULL
+          )
+        ''')
+
+    def key(self, digest, args):
+        return hashlib.blake2b((digest + '\0' + args).encode(),
+                               digest_size=16).hexdigest()
+
+    def file(self, key):
+        return self.path / key[:2] / (key + '.mp3')
+
+    def contains(self, key):
+        with self.lock:
+            return self.db.execute('''
+              SELECT 1 FROM entries WHERE key=?
+            ''', (key,)).fetchone() is not None
+
+    def fetch(self, key, dst_file):
+        """Put the cached file for key in dst_file, if there is one."""
+        with self.lock:
+            found = self.db.execute('''
+              UPDATE entries SET used=? WHERE key=?
+            ''', (time.time(), key)).rowcount
+            self.db.commit()
+        if not found:
+            return False
+        cache_file = self.file(key)
+        try:
+            self.copier.copy(cache_file, dst_file, os.stat(cache_file))
+        except FileNotFoundError:
+            logger.warning("missing from cache: %s", cache_file)
+            with self.lock:
+                self.db.execute('''
+                  DELETE FROM entries WHERE key=?
+                ''', (key,))
+                self.db.commit()
+            return False
+        with self.lock:
+            self.hits += 1
+        return True
+
+    def store(self, key, src_file):
+        cache_file = self.file(key)
+        cache_file.parent.mkdir(exist_ok=True)
+        # tracks with the same contents and tags have the same key, and
+        # can be stored at the same time by different workers
+        fd, tmp_name = tempfile.mkstemp(dir=cache_file.parent,
+                                        prefix=cache_file.name + '.',
+                                        suffix='.tmp')
+        os.close(fd)
+        tmp_file = pathlib.Path(tmp_name)
+        src_stat = os.stat(src_file)
+        try:
+            self.copier.copy(src_file, tmp_file, src_stat)
+            os.replace(tmp_file, cache_file)
+        except BaseException:
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
+            raise
+        with self.lock:
+            self.db.execute('''
+              REPLACE INTO entries (key, size, used) VALUES (?, ?, ?)
+            ''', (key, src_stat.st_size, time.time()))
+            self.db.commit()
+
+    def evict(self):
+        total, = self.db.execute('''
+          SELECT COALESCE(SUM(size), 0) FROM entries
+        ''').fetchone()
+        evicted = []
+        for key, size in self.db.execute('''
+          SELECT key, size FROM entries ORDER BY used
+        '''):
+            if total <= self.limit:
+                break
+            evicted.append((key,))
+            total -= size
+        for key, in evicted:
+            try:
+                os.remove(self.file(key))
+            except FileNotFoundError:
+                pass
+        self.db.executemany('''
+          DELETE FROM entries WHERE key=?
+        ''', evicted)
+        self.db.commit()
+        logger.info("transcode cache: %d hits, %d evicted, %.1f GB",
+                    self.hits, len(evicted), total / 2**30)
+
+
+def transcode_cached(cache, manifest, src_file, dst_file, args):
+    """Produce dst_file from the cache, or convert it and cache it.
+
+    Returns the stat and digest of the source, to be stored in the
+    manifest.  The manifest is only read, so this can run in worker
+    threads.
+    """
+    st = os.stat(src_file)
+    digest = (manifest.hashes.lookup(str(src_file), st)
+              or hash_file(src_file))
+    key = cache.key(digest, args)
+    if cache.fetch(key, dst_file):
+        logger.info("reusing conversion: %s", dst_file)
+    else:
+        transcode_file(src_file, dst_file, args)
+        cache.store(key, dst_file)
+    return st, digest
+
+
+class TranscodePool:
+    """Runs the ffmpeg conversions of an export in parallel.
+
+    Tracks are submitted while walking the playlists, and playlists are
+    deferred until all their tracks are done, so they never reference a
+    file that is still being written.  A track that fails is reported
+    and left out of its playlists, but does not stop the export.
+    """
+    def __init__(self, jobs, cache, manifest):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        self.cache = cache
+        self.manifest = manifest
+        self.tracks = {}
+        self.entries = {}
+        self.playlists = []
+
+    def submit(self, tid, src_file, dst_file, args, entry):
+        if self.cache:
+            self.tracks[tid] = self.executor.submit(
+                transcode_cached, self.cache, self.manifest,
+                src_file, dst_file, args)
+        else:
+            self.tracks[tid] = self.executor.submit(
+                transcode_file, src_file, dst_file, args)
+        self.entries[tid] = entry
+
+    def failed(self, tid):
+        future = self.tracks.get(tid)
+        return future is not None and future.exception() is not None
+
+    def add_playlist(self, pid, signature, playlist_file, entries):
+        self.playlists.append((pid, signature, playlist_file, entries))
+
+    def finish(self, skipped=()):
+        written = 0
+        for pid, signature, playlist_file, entries in self.playlists:
+            concurrent.futures.wait([
+                self.tracks[tid] for tid, _ in entries if tid in self.tracks
+            ])
+            files = [f for tid, f in entries
+                     if not self.failed(tid) and tid not in skipped]
+            content = ''.join(create_playlist(files))
+            digest = hashlib.blake2b(content.encode(),
+                                     digest_size=16).hexdigest()
+            if not self.manifest.playlist_current(pid, digest, playlist_file):
+                logger.info("writing playlist: %s", playlist_file)
+                save_file(playlist_file, content)
+                written += 1
+            self.manifest.update_playlist(pid, signature, digest,
+                                          playlist_file)
+        logger.info("wrote %d playlists, %d unchanged",
+                    written, len(self.playlists) - written)
+        self.executor.shutdown()
+
+        failures = [
+            (tid, future.exception())
+            for tid, future in self.tracks.items()
+            if future.exception() is not None
+        ]
+        for tid, err in failures:
+            logger.error("could not convert track %s: %s", tid, err)
+        for tid, entry in self.entries.items():
+            if not self.failed(tid):
+                self.manifest.update(tid, entry)
+                if self.cache:
+                    self.manifest.hashes.update(
+                        entry[0], *self.tracks[tid].result())
+        logger.info("converted %d tracks, %d failed",
+                    len(self.tracks) - len(failures), len(failures))
+        if self.cache:
+            self.cache.evict()
+
+
+def load_plan(db):
+    """Read everything the export needs from the data-base at once.
+
+    Returns a dictionary mapping the id of every visible playlist to its
+    name, modification date and track ids in order, and another one
+    mapping every track id in those playlists to its path, artist,
+    title, bpm and duration.
+    """
+    playlists = {}
+    tracks = {}
+    for (pid, name, modified, tid,
+         path_str, artist, title, bpm, duration) in db.execute('''
+      SELECT p.id, p.name, p.date_modified, pt.track_id,
+             tl.location, l.artist, l.title, l.bpm, l.duration
+      FROM Playlists p
+      LEFT JOIN PlaylistTracks pt ON pt.playlist_id = p.id
+      LEFT JOIN library l ON l.id = pt.track_id
+      LEFT JOIN track_locations tl ON tl.id = l.location
+      WHERE p.hidden = 0
+      ORDER BY p.id, pt.position
+    '''):
+        name, modified, tids = playlists.setdefault(pid, (name, modified, []))
+        if tid is None:
+            continue # empty playlist
+        if path_str is None:
+            logger.warning("no location for track %s in playlist: %s",
+                           tid, name)
+            continue
+        tids.append(tid)
+        tracks[tid] = (path_str, artist, title, bpm, duration)
+    logger.info("loaded %d playlists with %d tracks",
+                len(playlists), len(tracks))
+    return playlists, tracks
+
+
+def export_filename(tid, artist, title, bpm, ext):
+    """Name of the exported file of a track, ending in the track id so
+    that reimport.py can find it again."""
+    return sanitize_filename(unidecode(
         '__'.join([
             "%g" % (attr,) if isinstance(attr, float) else str(attr)
             for attr in [artist, title, bpm, tid]
             if bool(attr)
-        ]) + dst_ext
+        ]) + ext
     ))
+
+
+def plan_file(settings, tid, track, manifest, kind):
+    """Decide what needs to be done to export a track.
+
+    Returns the action, which is one of 'missing', 'current', 'adopt',
+    'transcode' or 'copy', followed by the source and destination files,
+    the stat of the source, the ffmpeg arguments and the manifest entry.
+    """
+    path_str, artist, title, bpm, duration = track
+
+    logger.debug("exporting track: %s, \"%s\"", tid, path_str)
+
+    # https://github.com/syncthing/syncthing/blob/8f8e8a92858ebb285fada3a09b568a04ec4cd132/lib/protocol/nativemodel_darwin.go#L8
+    # https://stackoverflow.com/questions/3194516/replace-special-characters-with-ascii-equivalent
+    src_file = pathlib.Path(path_str)
+    dst_ext = ".mp3" if settings.compat else src_file.suffix
+    dst_file = settings.tracks / export_filename(tid, artist, title, bpm,
+                                                 dst_ext)
     logger.debug("copying:\n  %s\n  %s", src_file, dst_file)
 
-    if dst_file.exists() and (
-            settings.compat or src_file.stat().st_size == dst_file.stat().st_size
+    try:
+        src_stat = src_file.stat()
+    except FileNotFoundError:
+        return 'missing', src_file, dst_file, None, None, None
+
+    transcode = settings.compat and src_file.suffix.lower() != ".mp3"
+    args = transcode_args(artist, title) if transcode else None
+    entry = (str(src_file), src_stat.st_mtime, src_stat.st_size,
+             'ffmpeg ' + args if transcode else kind, str(dst_file))
+
+    if manifest.is_current(tid, entry):
+        action = 'current'
+    elif tid not in manifest.tracks and str(dst_file) in manifest.present and (
+            settings.compat or src_stat.st_size == dst_file.stat().st_size
     ):
-        logger.debug("file already exists: %s", dst_file)
+        # exported by a version that did not keep a manifest yet
+        action = 'adopt'
+    elif transcode:
+        action = 'transcode'
     else:
-        try:
-            if settings.compat and src_file.suffix.lower() != ".mp3":
-                logger.info("converting: %s", dst_file)
-                ffmpy.FFmpeg(
-                    inputs={src_file: '-err_detect ignore_err'}, # add -nv when file breaks
-                    outputs={dst_file: '-b:a 320k -ignore_unknown '
-                             + ('-metadata artist="' + artist + '" ' if artist else '')
-                             + ('-metadata title="' + title +'"' if title else '')},
-                ).run()
-            else:
-                shutil.copyfile(src_file, dst_file)
-        except FileNotFoundError:
-            logger.warning("file not found: %s", src_file)
-        except:
-            logger.error("error while copying file: %s", dst_file)
-            try:
-                os.remove(dst_file)
-            except:
-                pass
-            raise
+        action = 'copy'
+    return action, src_file, dst_file, src_stat, args, entry
+
+
+def export_file(settings, tid, track, file_db, manifest, pool, scheduler):
+    # if we already copied this file, just return the target location
+    if ('track', tid) in file_db:
+        logger.debug("already exported: %s, %s", tid, file_db[('track', tid)])
+        return file_db[('track', tid)]
 
+    # when only updating playlists, trust what was exported before
+    if settings.playlists_only and manifest.exported(tid):
+        file_db[('track', tid)] = manifest.exported(tid)
+        return file_db[('track', tid)]
+
+    # otherwise copy the file and return the resulting filename
+    action, src_file, dst_file, src_stat, args, entry = plan_file(
+        settings, tid, track, manifest, scheduler.copier.kind)
+
+    # recording the file before the conversion is done makes sure that
+    # no two workers ever encode the same track
     file_db[('track', tid)] = dst_file
+
+    if action == 'missing':
+        logger.warning("file not found: %s", src_file)
+    elif action == 'current':
+        logger.debug("file up to date: %s", dst_file)
+    elif action == 'adopt':
+        logger.debug("file already exists: %s", dst_file)
+        manifest.update(tid, entry)
+    elif action == 'transcode':
+        pool.submit(tid, src_file, dst_file, args, entry)
+    else:
+        scheduler.submit(tid, src_file, dst_file, src_stat, entry)
+
     return dst_file
 
 
 def save_file(fname, content):
-    with open(fname, 'w') as f:
-        for txt in content:
-            f.write(txt)
+    # write next to the destination and rename, so the file is replaced
+    # atomically and sync tools never see half of it
+    tmp_fname = fname.with_name('.' + fname.name + '.tmp')
+    with open(tmp_fname, 'w') as f:
+        f.write(content)
+    os.replace(tmp_fname, fname)
+
+
+def playlist_signature(name, modified, tids):
+    return hashlib.blake2b(repr((name, modified, tids)).encode(),
+                           digest_size=16).hexdigest()
 
 
-def export_playlist(settings, db, pid, name, file_db):
+def export_playlist(settings, pid, name, modified, tids, tracks,
+                    file_db, manifest, pool, scheduler):
     if ('plist', pid) in file_db:
         logger.error("duplicate plist: %s (%s)", pid, name)
         return file_db['plist', pid]
 
-    tracks = db.execute('''
-      SELECT track_id, position
-      FROM PlaylistTracks
-      WHERE playlist_id=?
-      ORDER BY position
-    ''', (pid,))
     playlist_file = settings.plists / ("%s.pls" % name)
+    signature = playlist_signature(name, modified, tids)
+    if (settings.playlists_only and
+            manifest.playlist_unchanged(pid, signature)):
+        logger.debug("playlist unchanged: %s", playlist_file)
+        file_db[('plist', pid)] = playlist_file
+        return playlist_file
+
     logger.info("exporting playlist: %s", playlist_file)
 
-    files = [
-        '..' / export_file(settings, db, tid, file_db).relative_to(settings.path)
-        for tid, tpos in tracks
+    entries = [
+        (tid, '..' / export_file(settings, tid, tracks[tid],
+                                 file_db, manifest, pool, scheduler)
+                         .relative_to(settings.path))
+        for tid in tids
     ]
-    playlist = create_playlist(files)
-    save_file(playlist_file, playlist)
+    pool.add_playlist(pid, signature, playlist_file, entries)
     file_db[('plist', pid)] = playlist_file
     return playlist_file
 
 
+def plan_export(settings, playlists, tracks, manifest, cache, kind, old_files):
+    """Compute what an export would do, without copying anything.
+
+    Conversions are counted as cached when the digest of the source is
+    already known and its result is in the transcode cache, since
+    hashing would mean reading the source.  Durations and sizes of
+    conversions are estimated with TRANSCODE_SPEED and
+    TRANSCODE_BYTERATE.
+    """
+    counts = collections.Counter()
+    sizes = collections.Counter()
+    audio = 0
+    new_files = set()
+    for pid, (name, modified, tids) in playlists.items():
+        new_files.add(settings.plists / ("%s.pls" % name))
+    for tid in dict.fromkeys(tid for _, _, tids in playlists.values()
+                             for tid in tids):
+        action, src_file, dst_file, src_stat, args, entry = plan_file(
+            settings, tid, tracks[tid], manifest, kind)
+        duration = tracks[tid][4] or 0
+        new_files.add(dst_file)
+        if action == 'transcode' and cache:
+            digest = manifest.hashes.lookup(str(src_file), src_stat)
+            if digest and cache.contains(cache.key(digest, args)):
+                action = 'cached'
+        if action in ('current', 'adopt'):
+            size = dst_file.stat().st_size
+        elif action == 'copy':
+            size = src_stat.st_size
+        elif action in ('transcode', 'cached'):
+            size = int(duration * TRANSCODE_BYTERATE)
+        else:
+            size = 0
+        if action == 'transcode':
+            audio += duration
+        counts[action] += 1
+        sizes[action] += size
+
+    orphans = [f for f in old_files if f not in new_files]
+    return {
+        'playlists': len(playlists),
+        'tracks': {
+            action: {'files': counts[action], 'bytes': sizes[action]}
+            for action in counts
+        },
+        'copy_bytes': sizes['copy'],
+        'transcodes': counts['transcode'],
+        'transcode_seconds': audio / TRANSCODE_SPEED / settings.jobs,
+        'orphans': {
+            'files': len(orphans),
+            'bytes': sum(f.stat().st_size for f in orphans),
+            'paths': [str(f) for f in orphans],
+        },
+        'target_bytes': sum(sizes.values()),
+    }
+
+
+def verify(settings, manifest, copier, repair):
+    """Check that exported copies have the same contents as their sources.
+
+    Digests are kept in the manifest, so only files that changed since
+    the last verification are read again.
+    """
+    pairs = [
+        (tid, src, dst)
+        for tid, (src, mtime, size, encoder, dst) in manifest.tracks.items()
+        if encoder == 'copy'
+    ]
+    paths = sorted({path for _, src, dst in pairs for path in (src, dst)})
+    stats = {path: st
+             for path, st in stat_files(paths, settings.jobs).items() if st}
+    digests = manifest.hashes.hash_files(stats, settings.jobs)
+
+    mismatches = []
+    for tid, src, dst in pairs:
+        if src not in digests:
+            logger.warning("source missing: %s", src)
+        elif dst not in digests:
+            logger.error("copy missing: %s", dst)
+            mismatches.append((tid, src, dst))
+        elif digests[src] != digests[dst]:
+            logger.error("copy differs: %s", dst)
+            mismatches.append((tid, src, dst))
+    logger.info("verified %d files, %d bad copies", len(pairs), len(mismatches))
+
+    if repair:
+        for tid, src, dst in mismatches:
+            logger.info("copying again: %s", dst)
+            src_stat = os.stat(src)
+            copier.copy(pathlib.Path(src), pathlib.Path(dst), src_stat)
+            entry = manifest.tracks[tid]
+            manifest.update(tid, [src, src_stat.st_mtime, src_stat.st_size,
+                                  entry[3], dst])
+    return mismatches
+
+
 def main(compat = False):
     logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 
-    db = sqlite3.connect('./mixxxdb.sqlite')
-    settings = Settings(compat)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output', type=pathlib.Path, default=None,
+                        help="export folder (default: %s)" % (
+                            EXPORT_FOLDER_COMPAT if compat else EXPORT_FOLDER))
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="concurrent conversions (default: number of cores)")
+    parser.add_argument('--copy-mode', choices=['auto'] + COPY_MODES,
+                        default='auto',
+                        help="how tracks are copied (default: auto)")
+    parser.add_argument('--playlists-only', action='store_true',
+                        help="only export playlists that changed")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="do not use the shared transcode cache")
+    parser.add_argument('--plan', action='store_true',
+                        help="print what would be done as JSON and exit")
+    parser.add_argument('--verify', action='store_true',
+                        help="compare exported copies against their sources")
+    parser.add_argument('--repair', action='store_true',
+                        help="with --verify, copy bad files again")
+    args = parser.parse_args()
+
+    db = mixxxdb.open_readonly()
+    # planning is a dry run, it must not create or change any file
+    settings = Settings(compat, jobs=args.jobs,
+                        playlists_only=args.playlists_only, path=args.output,
+                        create=not args.plan)
     old_files = [
-        f for f in itertools.chain(
-            settings.tracks.iterdir(),
-            settings.plists.iterdir())
+        f for f in itertools.chain.from_iterable(
+            folder.iterdir() for folder in (settings.tracks, settings.plists)
+            if folder.is_dir())
         if f.is_file()
     ]
     file_db = {}
+    manifest = Manifest(settings.path / MANIFEST_NAME, old_files,
+                        readonly=args.plan)
+    cache = (TranscodeCache(TRANSCODE_CACHE, TRANSCODE_CACHE_SIZE,
+                            readonly=args.plan)
+             if compat and not args.no_cache else None)
+    pool = TranscodePool(settings.jobs, cache, manifest)
+    copier = Copier(args.copy_mode)
+    scheduler = CopyScheduler(copier)
 
-    playlists = db.execute('''
-      SELECT id, name
-      FROM Playlists
-      WHERE hidden = 0
-    ''')
+    if args.verify:
+        verify(settings, manifest, copier, args.repair)
+        manifest.commit()
+        return
 
-    for pid, name in playlists:
-        export_playlist(settings, db, pid, name, file_db)
+    playlists, tracks = load_plan(db)
+    db.close()
+
+    if args.plan:
+        plan = plan_export(settings, playlists, tracks, manifest, cache,
+                           copier.kind, old_files)
+        json.dump(plan, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+        return
+
+    for pid, (name, modified, tids) in playlists.items():
+        export_playlist(settings, pid, name, modified, tids, tracks,
+                        file_db, manifest, pool, scheduler)
+
+    scheduler.run(manifest)
+    pool.finish(scheduler.failed)
+    copier.report()
+    manifest.prune_playlists(playlists.keys())
+    if settings.playlists_only:
+        # tracks that are not in the playlists we looked at are still
+        # needed by the others
+        old_files = [f for f in old_files if f.parent == settings.plists]
+    else:
+        manifest.prune({tid for kind, tid in file_db if kind == 'track'})
+    manifest.commit()
 
     new_files=set(file_db.values())
     logger.info("cleaning up old files")
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2018 Juan Pedro Bolivar Puente
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the MIT License, as detailed in the LICENSE
+# file located at the root of this source code distribution,
+# or here: <https://github.com/arximboldi/lager/blob/master/LICENSE>
+#
+
+# filehash.py
+# -----------
+#
+# Hashing of track files, shared by the scripts that need to compare
+# file contents.  Digests can be kept in a side-car data-base, keyed
+# by path, size and mtime, so files are only read again when they
+# change.
+
+import os
+import logging
+import hashlib
+import concurrent.futures
+
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+# Size of the blocks read when hashing files
+HASH_CHUNK = 1 << 20
+
+def hash_file(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb', buffering=0) as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def stat_files(paths, jobs=None):
+    """Stat all paths in parallel, mapping missing files to None."""
+    def stat(path):
+        try:
+            return os.stat(path)
+        except OSError:
+            return None
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        return dict(zip(paths, executor.map(stat, paths)))
+
+class HashCache:
+    """Digests of files stored in a SQLite data-base.
+
+    It keeps them in its own table, so the data-base can be shared with
+    other data, like the manifest of export.py.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.db.execute('''
+          CREATE TABLE IF NOT EXISTS hashes (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            digest TEXT NOT NULL
+          )
+        ''')
+        self.hashes = {
+            path: entry for path, *entry in self.db.execute('''
+              SELECT path, size, mtime, digest FROM hashes
+            ''')
+        }
+
+    def lookup(self, path, st):
+        entry = self.hashes.get(path)
+        if entry and entry[:2] == [st.st_size, st.st_mtime]:
+            return entry[2]
+
+    def update(self, path, st, digest):
+        self.hashes[path] = [st.st_size, st.st_mtime, digest]
+        self.db.execute('''
+          REPLACE INTO hashes (path, size, mtime, digest)
+          VALUES (?, ?, ?, ?)
+        ''', (path, st.st_size, st.st_mtime, digest))
+
+    def hash_files(self, stats, jobs=None):
+        """Digests of all the files in stats, a dictionary from path to
+        the result of os.stat.  Files are hashed in parallel.
+        """
+        digests = {}
+        missing = []
+        for path, st in stats.items():
+            digest = self.lookup(path, st)
+            if digest:
+                digests[path] = digest
+            else:
+                missing.append(path)
+        logger.info("hashing %d files, %d cached", len(missing), len(digests))
+
+        def hash_or_none(path):
+            try:
+                return hash_file(path)
+            except OSError as err:
+                logger.warning("can not hash (%s): %s", err, path)
+        with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+            results = executor.map(hash_or_none, missing)
+            for path, digest in tqdm(zip(missing, results), total=len(missing)):
+                if digest is None:
+                    continue
+                digests[path] = digest
+                self.update(path, stats[path], digest)
+        self.db.commit()
+        return digests
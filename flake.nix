@@ -27,6 +27,7 @@
                 unidecode
                 m3u8
                 ffmpy
+                numpy
               ]
             ))
           ];
@@ -63,7 +64,7 @@
             }
 
             function backup() {
-                cp ./mixxxdb.sqlite "$(make-unique "./mixxxdb.sqlite.backup.$(date '+%Y-%m-%d')")"
+                snapshots.py save ./mixxxdb.sqlite
             }
           '';
         };
@@ -12,31 +12,136 @@
 #
 # Remove files that are marked as deleted and are not referenced from
 # any playslist.
+#
+# Before that, the deleted flags are refreshed from the file system,
+# since Mixxx only updates them when it rescans the library.  Every
+# directory with track locations is checked in parallel, and it is only
+# listed again when its mtime changed since the last run, the listings
+# are kept in an index in the format of fsindex.py.  Use --no-refresh to
+# trust the flags set by Mixxx instead.
 
 import sys
 import os
-import shutil
 import logging
-import sqlite3
+import argparse
+import concurrent.futures
+
+from tqdm import tqdm
+
+import mixxxdb
+import fsindex
+
 logger = logging.getLogger(__name__)
 
+# Listings of the directories of the track locations, see fsindex.py.
+# It is not the index of the music folders, since only some of their
+# directories are listed here.
+DIR_CACHE = './mixxxdb.dirs.sqlite'
+
+def list_dirs(cache, dirs, jobs=None):
+    """Names of the files in every directory in dirs, updating the
+    listings in cache.
+
+    A directory that does not exist is empty when its parent exists.
+    Otherwise it may be in a disk that is not mounted, so nothing is
+    known about it and its listing is None.
+    """
+    known = dict(cache.execute('SELECT path, mtime FROM dirs'))
+    listings = {}
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        results = executor.map(
+            lambda path: fsindex.scan_dir(path, known.get(path)), dirs)
+        for path, (mtime, files, _) in zip(
+                dirs, tqdm(results, total=len(dirs), unit='dir')):
+            if mtime is None:
+                if not os.path.isdir(os.path.dirname(path)):
+                    listings[path] = None
+                    continue
+                cache.execute('DELETE FROM files WHERE dir=?', (path,))
+                cache.execute('DELETE FROM dirs WHERE path=?', (path,))
+                listings[path] = set()
+            elif files is None:
+                listings[path] = {name for name, in cache.execute('''
+                  SELECT name FROM files WHERE dir=?
+                ''', (path,))}
+            else:
+                cache.execute('DELETE FROM files WHERE dir=?', (path,))
+                cache.executemany('''
+                  INSERT INTO files (path, dir, name, size, mtime)
+                  VALUES (?, ?, ?, ?, ?)
+                ''', [(os.path.join(path, name), path, name, size, mtime)
+                      for name, size, mtime in files])
+                cache.execute('''
+                  REPLACE INTO dirs (path, parent, mtime) VALUES (?, ?, ?)
+                ''', (path, None, mtime))
+                listings[path] = {name for name, _, _ in files}
+    cache.commit()
+    return listings
+
+def refresh_deleted(db, cache, jobs=None):
+    """Set the fs_deleted flag of every track location from the file
+    system."""
+    locations = db.execute('''
+      SELECT id, location, fs_deleted FROM track_locations
+      WHERE location IS NOT NULL
+    ''').fetchall()
+    dirs = sorted({os.path.dirname(location) for _, location, _ in locations})
+    logger.info("checking %d locations in %d directories",
+                len(locations), len(dirs))
+    listings = list_dirs(cache, dirs, jobs)
+    changes = []
+    unknown = set()
+    for lid, location, fs_deleted in locations:
+        directory, name = os.path.split(location)
+        if listings[directory] is None:
+            unknown.add(directory)
+            continue
+        deleted = int(name not in listings[directory])
+        if deleted != fs_deleted:
+            changes.append((deleted, lid))
+    db.executemany('''
+      UPDATE track_locations SET fs_deleted=? WHERE id=?
+    ''', changes)
+    db.commit()
+    if unknown:
+        logger.warning("kept the deleted flags in %d directories whose"
+                       " parent is missing too, is a disk unmounted?",
+                       len(unknown))
+    logger.info("updated %d deleted flags", len(changes))
+
+def forget(db):
+    """Delete the deleted track locations that are not used by any
+    playlist or crate."""
+    count = mixxxdb.delete_rows(db, 'track_locations', '''
+      SELECT tl.id
+      FROM track_locations tl
+      LEFT JOIN (SELECT l.location
+                 FROM library l
+                 JOIN PlaylistTracks pt ON pt.track_id = l.id
+                 UNION
+                 SELECT l.location
+                 FROM library l
+                 JOIN crate_tracks ct ON ct.track_id = l.id) used
+        ON used.location = tl.id
+      WHERE tl.fs_deleted = 1
+        AND used.location IS NULL
+    ''', unit='location')
+    logger.info("forgot %d locations", count)
+
 def main():
     logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
 
-    logger.info("copying database")
-    shutil.copyfile('./mixxxdb.sqlite',
-                    './mixxxdb.fixed.sqlite')
-    db = sqlite3.connect('mixxxdb.fixed.sqlite')
-
-    db.execute('''
-      DELETE FROM track_locations
-      WHERE fs_deleted=1
-        AND id NOT IN (SELECT location
-                       FROM library
-                       WHERE id IN (SELECT track_id FROM PlaylistTracks)
-                          OR id IN (SELECT track_id FROM crate_tracks))
-    ''')
-    db.commit()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="directories checked in parallel")
+    parser.add_argument('--no-refresh', action='store_true',
+                        help="trust the deleted flags set by Mixxx")
+    args = parser.parse_args()
+
+    db = mixxxdb.open_copy()
+    if not args.no_refresh:
+        refresh_deleted(db, fsindex.open_index(DIR_CACHE), args.jobs)
+    forget(db)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2018 Juan Pedro Bolivar Puente
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the MIT License, as detailed in the LICENSE
+# file located at the root of this source code distribution,
+# or here: <https://github.com/arximboldi/lager/blob/master/LICENSE>
+#
+
+# fsindex.py
+# ----------
+#
+# Keeps an index of the files in the music folders, so that files that
+# were moved on disk can be found again even when Mixxx has not
+# rescanned them yet.
+#
+# The index is a side-car SQLite data-base with the name, size, mtime
+# and path of every file.  Scans are incremental: a directory whose
+# mtime did not change is not listed again.  Note that modifying a file
+# in place does not change the mtime of its directory, so the size of
+# such files may be outdated until something else in the directory
+# changes.
+#
+# When run as a script, it just updates the index.
+
+import os
+import sys
+import logging
+import sqlite3
+import concurrent.futures
+
+logger = logging.getLogger(__name__)
+
+INDEX = './mixxxdb.files.sqlite'
+
+MUSIC_ROOTS = [
+    '/run/media/raskolnikov/aleph/musica',
+    '/home/raskolnikov/sync/aleph/musica',
+]
+
+def open_index(path=INDEX):
+    db = sqlite3.connect(path)
+    db.executescript('''
+      CREATE TABLE IF NOT EXISTS dirs (
+        path TEXT PRIMARY KEY,
+        parent TEXT,
+        mtime REAL NOT NULL
+      );
+      CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+      CREATE TABLE IF NOT EXISTS files (
+        path TEXT PRIMARY KEY,
+        dir TEXT NOT NULL,
+        name TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL
+      );
+      CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+      CREATE INDEX IF NOT EXISTS files_name_size ON files (name, size);
+    ''')
+    return db
+
+def scan_dir(path, known_mtime):
+    """List a directory, unless its mtime is known_mtime.
+
+    Returns the mtime of the directory, and if it changed, its files as
+    (name, size, mtime) and its subdirectories.
+    """
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError as err:
+        logger.warning("can not scan (%s): %s", err, path)
+        return None, None, None
+    if mtime == known_mtime:
+        return mtime, None, None
+    files, subdirs = [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.is_file():
+                    st = entry.stat()
+                    files.append((entry.name, st.st_size, st.st_mtime))
+            except OSError as err:
+                logger.warning("can not stat (%s): %s", err, entry.path)
+    return mtime, files, subdirs
+
+def scan(db, roots=MUSIC_ROOTS, jobs=None):
+    """Bring the index up to date with the contents of roots.
+
+    Directories are listed in parallel.  Unchanged directories are not
+    listed, but their subdirectories, as remembered by the index, are
+    still visited.
+    """
+    known = dict(db.execute('SELECT path, mtime FROM dirs'))
+    seen = set()
+    listed = 0
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        def submit(path, parent):
+            seen.add(path)
+            future = executor.submit(scan_dir, path, known.get(path))
+            pending[future] = (path, parent)
+        pending = {}
+        for root in roots:
+            submit(root, None)
+        while pending:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                path, parent = pending.pop(future)
+                mtime, files, subdirs = future.result()
+                if mtime is None:
+                    # keep what we know about unmounted disks
+                    seen.update(p for p in known
+                                if p.startswith(path + os.sep))
+                    continue
+                if files is None:
+                    subdirs = [sub for sub, in db.execute('''
+                      SELECT path FROM dirs WHERE parent=?
+                    ''', (path,))]
+                else:
+                    listed += 1
+                    db.execute('''
+                      DELETE FROM files WHERE dir=?
+                    ''', (path,))
+                    db.executemany('''
+                      INSERT INTO files (path, dir, name, size, mtime)
+                      VALUES (?, ?, ?, ?, ?)
+                    ''', [(os.path.join(path, name), path, name, size, mtime)
+                          for name, size, mtime in files])
+                    db.execute('''
+                      REPLACE INTO dirs (path, parent, mtime) VALUES (?, ?, ?)
+                    ''', (path, parent, mtime))
+                for sub in subdirs:
+                    submit(sub, path)
+
+    gone = [(path,) for path in known if path not in seen]
+    db.executemany('DELETE FROM files WHERE dir=?', gone)
+    db.executemany('DELETE FROM dirs WHERE path=?', gone)
+    db.commit()
+    logger.info("scanned %d directories, listed %d, %d removed",
+                len(seen), listed, len(gone))
+
+def find_moved(db, index=INDEX):
+    """Find new paths for track locations whose file is missing.
+
+    db is the Mixxx data-base.  A location is considered moved when its
+    file is not in the index nor on disk, and exactly one file in the
+    index has the same name and size, at a path that is not already a
+    track location.  Returns (id, old path, new path) tuples.
+
+    Pending changes in db are committed first, since the index can not
+    be detached again while it was read inside a transaction.
+    """
+    db.commit()
+    db.execute('ATTACH DATABASE ? AS fsindex', (index,))
+    try:
+        candidates = db.execute('''
+          SELECT tl.id, tl.location, MIN(f.path)
+          FROM track_locations tl
+          JOIN fsindex.files f ON f.name = tl.filename AND f.size = tl.filesize
+          WHERE NOT EXISTS (SELECT 1 FROM fsindex.files
+                            WHERE path = tl.location)
+            AND NOT EXISTS (SELECT 1 FROM track_locations
+                            WHERE location = f.path)
+          GROUP BY tl.id
+          HAVING COUNT(*) = 1
+        ''').fetchall()
+    finally:
+        db.execute('DETACH DATABASE fsindex')
+    return [
+        (lid, old_path, new_path)
+        for lid, old_path, new_path in candidates
+        if not os.path.exists(old_path) and os.path.exists(new_path)
+    ]
+
+def apply_moved(db, moved):
+    """Point the track locations in moved to their new paths."""
+    for lid, old_path, new_path in moved:
+        logger.info("moved: %s\n    -> %s", old_path, new_path)
+    db.executemany('''
+      UPDATE track_locations
+      SET location=?, filename=?, directory=?, fs_deleted=0
+      WHERE id=?
+    ''', [
+        (new_path, os.path.basename(new_path), os.path.dirname(new_path), lid)
+        for lid, old_path, new_path in moved
+    ])
+    logger.info("found %d moved files", len(moved))
+
+def main():
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    scan(open_index(), sys.argv[1:] or MUSIC_ROOTS)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2018 Juan Pedro Bolivar Puente
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the MIT License, as detailed in the LICENSE
+# file located at the root of this source code distribution,
+# or here: <https://github.com/arximboldi/lager/blob/master/LICENSE>
+#
+
+# mixxxdb.py
+# ----------
+#
+# Opening and editing the Mixxx data-base, shared by all the scripts.
+#
+# The scripts that modify the data-base never touch the original: they
+# work on a copy, `mixxxdb.fixed.sqlite`, that can then be reviewed and
+# put in place.  The copy is made with the SQLite online backup API,
+# which gives a consistent snapshot even if Mixxx is running, and it is
+# opened with settings that favour speed over durability, since it can
+# always be made again.
+
+import logging
+import pathlib
+import sqlite3
+
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+SOURCE = './mixxxdb.sqlite'
+TARGET = './mixxxdb.fixed.sqlite'
+
+# Number of pages copied at a time when making a copy of the data-base
+BACKUP_PAGES = 4096
+
+# Number of rows deleted per transaction by delete_rows()
+DELETE_CHUNK = 1000
+
+PRAGMAS = [
+    # keep the rollback journal in memory, the copy can always be made
+    # again, and this keeps the file a single self-contained data-base
+    # that can be copied over the one of Mixxx
+    ('journal_mode', 'MEMORY'),
+    ('synchronous', 'OFF'),
+    # in KiB when negative
+    ('cache_size', -256 * 1024),
+    ('mmap_size', 1 << 30),
+    ('temp_store', 'MEMORY'),
+]
+
+def tune(db):
+    for name, value in PRAGMAS:
+        db.execute('PRAGMA %s=%s' % (name, value))
+    return db
+
+def open_readonly(path=SOURCE, immutable=False):
+    """Open the data-base without writing to it.
+
+    With immutable, SQLite does not even take locks, which is faster but
+    only safe when Mixxx is not running.
+    """
+    uri = pathlib.Path(path).absolute().as_uri() + '?mode=ro'
+    if immutable:
+        uri += '&immutable=1'
+    db = sqlite3.connect(uri, uri=True)
+    db.execute('PRAGMA mmap_size=%d' % (1 << 30))
+    return db
+
+def open_copy(source=SOURCE, target=TARGET):
+    """Copy the data-base at source to target, and open the copy."""
+    logger.info("copying database")
+    src = open_readonly(source)
+    db = sqlite3.connect(target)
+    with tqdm(unit='page') as progress:
+        def report(status, remaining, total):
+            progress.total = total
+            progress.n = total - remaining
+            progress.refresh()
+        src.backup(db, pages=BACKUP_PAGES, progress=report)
+    src.close()
+    return tune(db)
+
+def delete_rows(db, table, query, unit='row'):
+    """Delete the rows of table with the ids returned by query, a chunk
+    at a time.  Returns the number of rows deleted.
+
+    The ids are kept in a temporary table, so query is only run once,
+    and every chunk is committed, so a big delete does not hold the
+    whole journal in memory.
+    """
+    db.execute('''
+      CREATE TEMP TABLE delete_ids (id INTEGER PRIMARY KEY)
+    ''')
+    db.execute('INSERT INTO delete_ids (id) ' + query)
+    ids = [rid for rid, in db.execute('SELECT id FROM delete_ids ORDER BY id')]
+    with tqdm(total=len(ids), unit=unit) as progress:
+        for i in range(0, len(ids), DELETE_CHUNK):
+            chunk = ids[i:i + DELETE_CHUNK]
+            db.execute('''
+              DELETE FROM %s
+              WHERE id IN (SELECT id FROM delete_ids WHERE id BETWEEN ? AND ?)
+            ''' % table, (chunk[0], chunk[-1]))
+            db.commit()
+            progress.update(len(chunk))
+    db.execute('DROP TABLE delete_ids')
+    db.commit()
+    return len(ids)
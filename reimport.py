@@ -11,73 +11,198 @@
 # reimport.py
 # -----------
 #
-# Reimports a playlist exported from Rekordbox. It assumes the tracks
+# Reimports playlists exported from Rekordbox. It assumes the tracks
 # have been previously exported with export.py, so they can be found
 # using the ID that is contained at the end of the filename.
+#
+# Takes any number of playlists, or directories with playlists, which
+# are all imported at once into a single copy of the data-base.
+#
+# Files without an ID, because they were renamed or do not come from
+# export.py, are looked up by the name export.py would have given them
+# without the ID, and then by the artist, title and duration in the
+# playlist entry.
 
 import logging
-import sqlite3
 import os.path
 import re
 import sys
-import shutil
 import pathlib
+import argparse
 import unicodedata
+import concurrent.futures
 import m3u8
 
 from pathlib import Path
 
+import mixxxdb
+
+from export import export_filename
+from dedup import normalize
+
 
 logger = logging.getLogger(__name__)
 
+PLAYLIST_SUFFIXES = ['.m3u8', '.m3u']
+
+id_regex = re.compile(r'.*__(\d+)$')
+
+def find_playlists(paths):
+    """The playlist files in paths, looking inside directories."""
+    playlists = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            playlists.extend(sorted(
+                p for p in path.iterdir() if p.suffix in PLAYLIST_SUFFIXES))
+        else:
+            playlists.append(path)
+    return playlists
+
+def parse_playlist(playlist_file):
+    """The (position, uri, title, duration) of every entry in a playlist
+    file."""
+    playlist = m3u8.load(str(playlist_file))
+    return [(position, item.uri, item.title, item.duration)
+            for position, item in enumerate(playlist.segments, 1)]
+
+def parse_track_id(uri):
+    """The track id in the name of a file exported by export.py, or
+    None."""
+    matches = id_regex.match(Path(uri).stem)
+    return int(matches[1]) if matches else None
+
+class Resolver:
+    """Finds tracks for playlist entries without a valid ID.
+
+    Two indexes are built at once from the library: the name export.py
+    gives to every track, without the ID, and the normalized artist,
+    title and duration.  Keys shared by several tracks are ambiguous and
+    never match.
+    """
+    def __init__(self, db):
+        self.ids = set()
+        self.names = {}
+        self.tags = {}
+        for tid, artist, title, bpm, duration, path_str in db.execute('''
+          SELECT l.id, l.artist, l.title, l.bpm, l.duration, tl.location
+          FROM library l
+          LEFT JOIN track_locations tl ON tl.id = l.location
+        '''):
+            self.ids.add(tid)
+            suffixes = {'.mp3', Path(path_str).suffix if path_str else '.mp3'}
+            for suffix in suffixes:
+                self.add(self.names, export_filename(
+                    None, artist, title, bpm, suffix), tid)
+            if artist and title and duration:
+                self.add(self.tags, (normalize(artist), normalize(title),
+                                     round(duration)), tid)
+        logger.info("indexed %d tracks", len(self.ids))
+
+    def add(self, index, key, tid):
+        index[key] = tid if index.get(key, tid) == tid else None
+
+    def resolve(self, uri, title, duration):
+        """The id of the track for an entry, or None."""
+        path = Path(uri)
+        tid = self.names.get(path.name)
+        if tid is None:
+            # the id may be stale, the name without it can still match
+            matches = id_regex.match(path.stem)
+            if matches:
+                stem = path.stem[:matches.start(1) - 2]
+                tid = self.names.get(stem + path.suffix)
+        if tid is None and title and duration:
+            duration = round(duration)
+            # Rekordbox writes "artist - title", try both ways
+            parts = title.split(' - ', 1)
+            for artist, title in [parts, parts[::-1]] if len(parts) == 2 else []:
+                for d in (duration, duration - 1, duration + 1):
+                    tid = self.tags.get((normalize(artist), normalize(title), d))
+                    if tid is not None:
+                        return tid
+        return tid
+
 def main():
     logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 
-    if len(sys.argv) != 2:
-        logger.warning("need to pass a backup file")
-        return
-
-    logger.info("copying database")
-    shutil.copyfile('./mixxxdb.sqlite',
-                    './mixxxdb.fixed.sqlite')
-    db = sqlite3.connect('mixxxdb.fixed.sqlite')
-
-
-    playlist_file = sys.argv[1]
-    playlist = m3u8.load(playlist_file)
-    playlist_name = Path(playlist_file).stem
-
-    playlist_id, = db.execute('''
-      INSERT INTO Playlists (name, position, date_created, date_modified)
-      VALUES (?, 0, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-      RETURNING id
-    ''', (playlist_name,)).fetchone()
-
-    logger.info("creating new playlist: %s, with id: %s", playlist_name, playlist_id)
-
-    id_regex = re.compile('.*__(\d*)')
-    position = 0
-    for item in playlist.segments:
-        position += 1
-        path = Path(item.uri)
-        matches = id_regex.match(path.stem)
-        if matches == None:
-            logger.warn("could not parse item: %s", path.name)
-            continue
-        track_id = matches[1]
-        data = db.execute('''
-          SELECT artist, title
-          FROM library
-          WHERE id=?
-        ''', (track_id,)).fetchone()
-        if data == None:
-            logger.warn("could not finde item: %s", path.name)
-            continue
-        logger.info("found '%s' - '%s' for: %s", data[0], data[1], path.name)
-        db.execute('''
-          INSERT INTO PlaylistTracks (playlist_id, track_id, position, pl_datetime_added)
-          VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-        ''', (playlist_id, track_id, position))
+    parser = argparse.ArgumentParser()
+    parser.add_argument('playlists', nargs='+',
+                        help="playlist files, or directories with them")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="playlists parsed in parallel")
+    args = parser.parse_args()
+
+    playlist_files = find_playlists(args.playlists)
+    logger.info("parsing %d playlists", len(playlist_files))
+    with concurrent.futures.ProcessPoolExecutor(args.jobs) as executor:
+        parsed = list(executor.map(parse_playlist, playlist_files))
+
+    db = mixxxdb.open_copy()
+    resolver = Resolver(db)
+    resolved = 0
+
+    db.execute('''
+      CREATE TEMP TABLE reimport_entries (
+        playlist_id INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        track_id INTEGER,
+        uri TEXT NOT NULL
+      )
+    ''')
+    for playlist_file, entries in zip(playlist_files, parsed):
+        playlist_name = playlist_file.stem
+        playlist_id, = db.execute('''
+          INSERT INTO Playlists (name, position, date_created, date_modified)
+          VALUES (?, 0, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+          RETURNING id
+        ''', (playlist_name,)).fetchone()
+        logger.info("creating new playlist: %s, with id: %s",
+                    playlist_name, playlist_id)
+        rows = []
+        for position, uri, title, duration in entries:
+            tid = parse_track_id(uri)
+            if tid not in resolver.ids:
+                found = resolver.resolve(uri, title, duration)
+                if found is not None:
+                    logger.debug("resolved %s to: %s", uri, found)
+                    tid = found
+                    resolved += 1
+            rows.append((playlist_id, position, tid, uri))
+        db.executemany('''
+          INSERT INTO reimport_entries (playlist_id, position, track_id, uri)
+          VALUES (?, ?, ?, ?)
+        ''', rows)
+
+    imported = db.execute('''
+      INSERT INTO PlaylistTracks (playlist_id, track_id, position, pl_datetime_added)
+      SELECT e.playlist_id, e.track_id, e.position, CURRENT_TIMESTAMP
+      FROM reimport_entries e
+      JOIN library l ON l.id = e.track_id
+      ORDER BY e.playlist_id, e.position
+    ''').rowcount
+    unparsed = ['%s: %s' % (name, Path(uri).name) for name, uri in db.execute('''
+      SELECT p.name, e.uri
+      FROM reimport_entries e
+      JOIN Playlists p ON p.id = e.playlist_id
+      WHERE e.track_id IS NULL
+    ''')]
+    missing = ['%s: %s' % (name, Path(uri).name) for name, uri in db.execute('''
+      SELECT p.name, e.uri
+      FROM reimport_entries e
+      JOIN Playlists p ON p.id = e.playlist_id
+      LEFT JOIN library l ON l.id = e.track_id
+      WHERE e.track_id IS NOT NULL
+        AND l.id IS NULL
+    ''')]
+
+    logger.info("imported %d tracks, %d found without their id",
+                imported, resolved)
+    if unparsed:
+        logger.warning("could not parse %d items:\n    %s",
+                       len(unparsed), '\n    '.join(unparsed))
+    if missing:
+        logger.warning("could not find %d items:\n    %s",
+                       len(missing), '\n    '.join(missing))
 
     logger.info("committing")
     db.commit()
@@ -15,106 +15,213 @@
 # missing, and tries to find other entries that are similar and could
 # replace it, using heuristics (artist name, track name, etc.), not
 # necessarily the same file...
+#
+# With --find-moved, it first updates the index of the music folders
+# (see fsindex.py) and points locations whose file is missing to a file
+# with the same name and size somewhere else, in case it was just moved.
 
 import os.path
 import re
 import sys
-import shutil
 import pathlib
 import logging
-import sqlite3
+import collections
+import argparse
 
-logger = logging.getLogger(__name__)
+import numpy as np
 
-def relocate_file(db, tid):
-    all_attrs = db.execute('''
-      SELECT *
-      FROM library
-      WHERE id=?
-    ''', (tid,)).fetchone()
-    if all_attrs == None:
-        logger.error("Pretty bad, no track found for ID: %s", tid)
-        return
-
-    location, artist, title, bpm = db.execute('''
-      SELECT location, artist, title, bpm
-      FROM library
-      WHERE id=?
-    ''', (tid,)).fetchone()
-    path_str, = db.execute('''
-      SELECT location
-      FROM track_locations
-      WHERE id=?
-    ''', (location,)).fetchone()
-
-    src_file=pathlib.Path(path_str)
-    if src_file.exists():
-        return
-
-    logger.info("relocating file: %s", path_str)
-    matches = db.execute('''
-      SELECT *
-      FROM library
-      WHERE id<>? AND artist LIKE ? AND title LIKE ?
-    ''', (tid, artist, title))
-    best_match = None
-    best_match_rank = 0
-    for match in matches:
-        logger.debug("considering: %s", match)
-        rank = [a == b for a, b in zip(match, all_attrs)].count(True)
-        if rank > best_match_rank:
-            best_match_rank = rank
-            best_match = match
-
-    if not best_match:
-        logger.warning("no alternative found for: %s", path_str)
-        return
-
-    new_location, = db.execute('''
-      SELECT location
-      FROM library
-      WHERE id=?
-    ''', (best_match[0],)).fetchone()
-    new_path_str, = db.execute('''
-      SELECT location
-      FROM track_locations
-      WHERE id=?
-    ''', (new_location,)).fetchone()
-
-    logger.debug("best match: %s", best_match)
-    logger.info("new path: %s", new_path_str)
-    db.execute('''
-      UPDATE library SET location=? WHERE id=?
-    ''', (new_location, tid))
+import mixxxdb
+import fsindex
 
-def relocate_playlist(db, pid, name):
-    tracks = db.execute('''
-      SELECT track_id, position
-      FROM PlaylistTracks
-      WHERE playlist_id=?
-      ORDER BY position
-    ''', (pid,))
-    logger.info("relocating playlist: %s", name)
+logger = logging.getLogger(__name__)
 
-    for tid, tpos in tracks:
-        relocate_file(db, tid)
+# Columns used to pick the best replacement for a missing track, with
+# their weight and the tolerance for numeric columns (None for columns
+# that must be equal).  Artist and title always match already.
+SCORE_COLUMNS = [
+    ('duration', 4, 1),
+    ('bpm', 2, 0.5),
+    ('album', 2, None),
+    ('year', 1, None),
+    ('genre', 1, None),
+    ('key', 1, None),
+    ('filetype', 1, None),
+    ('bitrate', 1, None),
+    ('samplerate', 1, None),
+]
+
+# Replacements with a lower confidence, that is, fraction of the
+# weights of the SCORE_COLUMNS known in both tracks that match, are not
+# used
+MIN_CONFIDENCE = 0.5
+
+def normalize(text):
+    return text.strip().lower() if text else None
+
+class Library:
+    """In-memory copy of the library, indexed by artist and title.
+
+    Loading it once makes every lookup a dictionary access, instead of
+    several queries and a full table scan per missing track.  The
+    columns used for scoring candidates are also kept as NumPy arrays,
+    with text columns turned into integer codes, -1 and NaN standing
+    for missing values.
+    """
+    def __init__(self, db):
+        cursor = db.execute('''
+          SELECT * FROM library
+        ''')
+        self.columns = [column[0] for column in cursor.description]
+        self.rows = {row[0]: row for row in cursor}
+        self.paths = dict(db.execute('''
+          SELECT id, location FROM track_locations
+        '''))
+        self.index = collections.defaultdict(list)
+        for tid, row in self.rows.items():
+            key = self.key(row)
+            if all(key):
+                self.index[key].append(tid)
+        self.exists = {}
+
+        self.positions = {tid: i for i, tid in enumerate(self.rows)}
+        self.arrays = {}
+        # timesplayed is not scored, only used to break ties
+        for column, weight, tolerance in SCORE_COLUMNS + [
+                ('timesplayed', 0, 0)]:
+            if column not in self.columns:
+                continue
+            values = [self.get(row, column) for row in self.rows.values()]
+            if tolerance is None:
+                codes = {}
+                self.arrays[column] = np.array([
+                    codes.setdefault(value, len(codes))
+                    if value not in (None, '') else -1
+                    for value in values
+                ])
+            else:
+                self.arrays[column] = np.array([
+                    value if isinstance(value, (int, float)) else np.nan
+                    for value in values
+                ], dtype=float)
+        logger.info("loaded %d tracks", len(self.rows))
+
+    def get(self, row, column):
+        return row[self.columns.index(column)]
+
+    def key(self, row):
+        return (normalize(self.get(row, 'artist')),
+                normalize(self.get(row, 'title')))
+
+    def path(self, tid):
+        return self.paths.get(self.get(self.rows[tid], 'location'))
+
+    def file_exists(self, tid):
+        path_str = self.path(tid)
+        if path_str not in self.exists:
+            self.exists[path_str] = bool(path_str) and os.path.exists(path_str)
+        return self.exists[path_str]
+
+def find_candidates(library, tids):
+    """Pairs of missing tracks in tids and existing tracks that could
+    replace them."""
+    pairs = []
+    for tid in tids:
+        if tid not in library.rows:
+            logger.error("Pretty bad, no track found for ID: %s", tid)
+            continue
+        if library.file_exists(tid):
+            continue
+        logger.info("relocating file: %s", library.path(tid))
+        candidates = [
+            other
+            for other in library.index.get(library.key(library.rows[tid]), [])
+            if other != tid and library.file_exists(other)
+        ]
+        if not candidates:
+            logger.warning("no alternative found for: %s", library.path(tid))
+        pairs.extend((tid, other) for other in candidates)
+    return pairs
+
+def score_candidates(library, pairs):
+    """Pick the best candidate for every missing track.
+
+    All pairs are scored at once with array operations.  Ties are broken
+    by how often the candidate was played, then by its id.  Returns
+    (track, candidate, confidence) tuples.
+    """
+    if not pairs:
+        return []
+    a = np.array([library.positions[tid] for tid, _ in pairs])
+    b = np.array([library.positions[other] for _, other in pairs])
+    score = np.zeros(len(pairs))
+    total = np.zeros(len(pairs))
+    for column, weight, tolerance in SCORE_COLUMNS:
+        if column not in library.arrays:
+            continue
+        values = library.arrays[column]
+        if tolerance is None:
+            known = (values[a] >= 0) & (values[b] >= 0)
+            match = known & (values[a] == values[b])
+        else:
+            known = ~np.isnan(values[a]) & ~np.isnan(values[b])
+            match = np.abs(values[a] - values[b]) <= tolerance
+        # columns missing in either track do not count either way
+        score += weight * match
+        total += weight * known
+    confidence = np.divide(score, total, out=np.zeros(len(pairs)),
+                           where=total > 0)
+
+    tids = np.array([tid for tid, _ in pairs])
+    others = np.array([other for _, other in pairs])
+    played = library.arrays.get('timesplayed')
+    played = (np.nan_to_num(played[b]) if played is not None
+              else np.zeros(len(pairs)))
+    order = np.lexsort((others, -played, -confidence, tids))
+    _, first = np.unique(tids[order], return_index=True)
+    best = order[first]
+    return list(zip(tids[best].tolist(), others[best].tolist(),
+                    confidence[best].tolist()))
 
 def main():
     logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 
-    logger.info("copying database")
-    shutil.copyfile('./mixxxdb.sqlite',
-                    './mixxxdb.fixed.sqlite')
-    db = sqlite3.connect('mixxxdb.fixed.sqlite')
-
-    playlists = db.execute('''
-      SELECT id, name
-      FROM Playlists
-      WHERE hidden = 0
-    ''')
-
-    for pid, name in playlists:
-        relocate_playlist(db, pid, name)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--find-moved', action='store_true',
+                        help="look for missing files in the music folders")
+    parser.add_argument('--min-confidence', type=float, default=MIN_CONFIDENCE,
+                        help="skip replacements with a lower confidence")
+    args = parser.parse_args()
+
+    db = mixxxdb.open_copy()
+    if args.find_moved:
+        fsindex.scan(fsindex.open_index())
+        fsindex.apply_moved(db, fsindex.find_moved(db))
+    library = Library(db)
+
+    tids = [tid for tid, in db.execute('''
+      SELECT DISTINCT pt.track_id
+      FROM Playlists p
+      JOIN PlaylistTracks pt ON pt.playlist_id = p.id
+      WHERE p.hidden = 0
+    ''')]
+
+    logger.info("looking for missing files in %d tracks", len(tids))
+    updates = []
+    for tid, other, confidence in score_candidates(
+            library, find_candidates(library, tids)):
+        path_str, new_path_str = library.path(tid), library.path(other)
+        if confidence < args.min_confidence:
+            logger.warning("low confidence (%.2f) for: %s\n    -> %s",
+                           confidence, path_str, new_path_str)
+            continue
+        logger.info("new path (%.2f): %s\n    -> %s",
+                    confidence, path_str, new_path_str)
+        updates.append((library.get(library.rows[other], 'location'), tid))
+
+    db.executemany('''
+      UPDATE library SET location=? WHERE id=?
+    ''', updates)
+    logger.info("relocated %d tracks", len(updates))
 
     logger.info("committing")
     db.commit()
@@ -17,109 +17,209 @@
 # path, and changes the location so that it matches the new prefix.
 #
 # It doesn't delete the duplicates. For that, run dedupe.py
+#
+# The prefixes are read from repath.conf.  To find new ones, run it with
+# --discover db (or disk, to look at the index of the music folders in
+# fsindex.py instead): missing files are matched by name and size with
+# existing ones, and the most common prefix changes are printed in the
+# format of repath.conf.
+#
+# With --find-moved, locations that are still missing afterwards are
+# looked up by name and size in the index of the music folders (see
+# fsindex.py).
 
 import sys
 import os
-import shutil
 import logging
-import sqlite3
 import pathlib
+import argparse
+import collections
+
+import mixxxdb
+import fsindex
+
+from filehash import stat_files
 
 logger = logging.getLogger(__name__)
 
-TRANSFORMS = [
-    # Old symlinks
-    (
-        '/home/raskolnikov/media/mpd/music/alexandria',
-        '/media/raskolnikov/alexandria/musica',
-    ),
-    (
-        '/home/raskolnikov/media/mpd/music/hd-alexandria',
-        '/media/raskolnikov/alexandria/musica',
-    ),
-    (
-        '/var/lib/mpd/music/hd-raskolnikov',
-        '/media/raskolnikov/alexandria/musica',
-    ),
-    # Moving stuff to new locations...
-    (
-        '/media/raskolnikov/alexandria/musica',
-        '/run/media/raskolnikov/aleph/musica',
-    ),
-    (
-        '/run/media/raskolnikov/alexandria/musica',
-        '/run/media/raskolnikov/aleph/musica',
-    ),
-    (
-        '/home/raskolnikov/sync/music/unsorted',
-        '/home/raskolnikov/sync/aleph/musica/unsorted/2017',
-    ),
-    (
-        '/home/raskolnikov/sync/music/unsorted',
-        '/home/raskolnikov/sync/aleph/musica/unsorted/2018',
-    ),
-    (
-        '/home/raskolnikov/sync/music/unsorted',
-        '/home/raskolnikov/sync/aleph/musica/unsorted/2019',
-    ),
-    (
-        '/home/raskolnikov/sync/music/unsorted',
-        '/home/raskolnikov/sync/aleph/musica/unsorted/2020',
-    ),
-    (
-        '/home/raskolnikov/sync/music/unsorted',
-        '/home/raskolnikov/sync/aleph/musica/unsorted/2021',
-    ),
-    (
-        '/home/raskolnikov/sync/music/unsorted',
-        '/home/raskolnikov/sync/aleph/musica/unsorted/2022',
-    ),
-    (
-        '/home/raskolnikov/sync/music/unsorted',
-        '/home/raskolnikov/sync/aleph/musica/unsorted/2023',
-    ),
-    (
-        '/home/raskolnikov/sync/music/unsorted',
-        '/home/raskolnikov/sync/aleph/musica/unsorted/2024',
-    ),
-]
+# File with the list of transforms, see load_transforms
+TRANSFORMS = pathlib.Path(__file__).parent / 'repath.conf'
+
+def load_transforms(path):
+    """Read (old prefix, new prefix) pairs, one per line, separated by
+    '->'.  Empty lines and lines starting with # are ignored."""
+    transforms = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            old_prefix, new_prefix = line.split('->')
+            transforms.append((old_prefix.strip().rstrip('/'),
+                               new_prefix.strip().rstrip('/')))
+    return transforms
+
+class PrefixTrie:
+    """Transforms indexed by the components of their old prefix."""
+    def __init__(self, transforms):
+        self.root = {}
+        for old_prefix, new_prefix in transforms:
+            node = self.root
+            for part in old_prefix.split('/'):
+                node = node.setdefault(part, {})
+            node.setdefault(None, []).append((old_prefix, new_prefix))
+
+    def rewrites(self, location):
+        """All the ways of rewriting location, longest prefix first."""
+        matches = []
+        node = self.root
+        for part in location.split('/'):
+            node = node.get(part)
+            if node is None:
+                break
+            matches.append(node.get(None, []))
+        return [
+            new_prefix + location[len(old_prefix):]
+            for found in reversed(matches)
+            for old_prefix, new_prefix in found
+        ]
+
+def resolve(trie, locations, location, seen=frozenset()):
+    """Find the new location for a location, or None.
+
+    Chains of transforms are followed, also through locations that are
+    not in the data-base, and the result is the last location along the
+    chain that is.
+    """
+    seen = seen | {location}
+    for new_location in trie.rewrites(location):
+        if new_location in seen:
+            continue
+        further = resolve(trie, locations, new_location, seen)
+        if further:
+            return further
+        if new_location in locations:
+            return new_location
+    return None
+
+def common_prefixes(old_location, new_location):
+    """Strip the common trailing path components of two locations."""
+    old_parts = old_location.split('/')
+    new_parts = new_location.split('/')
+    while (len(old_parts) > 1 and len(new_parts) > 1
+           and old_parts[-1] == new_parts[-1]):
+        old_parts.pop()
+        new_parts.pop()
+    return '/'.join(old_parts), '/'.join(new_parts)
+
+def discover(db, source, jobs=None):
+    """Guess prefix transforms from files that went missing.
+
+    Missing locations are matched with existing files of the same name
+    and size, grouping both sides by (name, size) in a dictionary, and
+    only unambiguous matches are kept.  Returns the ((old prefix, new
+    prefix), support) pairs, most common first.
+    """
+    rows = db.execute('''
+      SELECT location, filename, filesize FROM track_locations
+      WHERE location IS NOT NULL
+        AND filesize IS NOT NULL
+    ''').fetchall()
+    logger.info("checking %d locations", len(rows))
+    stats = stat_files([location for location, _, _ in rows], jobs)
+    missing = [(location, name, size) for location, name, size in rows
+               if stats[location] is None]
+
+    if source == 'disk':
+        index = fsindex.open_index()
+        fsindex.scan(index)
+        existing = index.execute('''
+          SELECT path, name, size FROM files
+        ''')
+    else:
+        existing = [(location, name, size) for location, name, size in rows
+                    if stats[location] is not None]
+    by_key = collections.defaultdict(list)
+    for location, name, size in existing:
+        by_key[(name, size)].append(location)
+
+    logger.info("matching %d missing locations", len(missing))
+    support = collections.Counter()
+    for location, name, size in missing:
+        matches = by_key.get((name, size), [])
+        if len(matches) == 1:
+            support[common_prefixes(location, matches[0])] += 1
+    return support.most_common()
 
 def main():
     logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
 
-    logger.info("copying database")
-    shutil.copyfile('./mixxxdb.sqlite',
-                    './mixxxdb.fixed.sqlite')
-    db = sqlite3.connect('mixxxdb.fixed.sqlite')
-
-    for old_prefix, new_prefix in TRANSFORMS:
-        logger.info("moving %s to %s" % (old_prefix, new_prefix))
-        logger.info("finding matching locations")
-
-        matches = db.execute('''
-          SELECT id, location FROM track_locations WHERE location LIKE ?
-        ''', (old_prefix + '%',))
-
-        logger.info("fixing matching locations")
-        for id, location in matches:
-            new_location = new_prefix + location[len(old_prefix):]
-            new_id = db.execute('''
-                SELECT id FROM track_locations WHERE location = ?
-            ''', (new_location,)).fetchone()
-            if new_id:
-                new_id, = new_id
-                logger.info("moving from %s to %s", location, new_location)
-                db.execute('''
-                  UPDATE library SET location=? WHERE location=?
-                ''', (new_id, id))
-                db.execute('''
-                  DELETE FROM track_analysis WHERE track_id=?
-                ''', (id,))
-                db.execute('''
-                  DELETE FROM track_locations WHERE id=?
-                ''', (id,))
-            elif not pathlib.Path(location).exists():
-                logger.info("no replacement for: %s", location)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transforms', default=TRANSFORMS,
+                        help="file with the prefix transforms")
+    parser.add_argument('--find-moved', action='store_true',
+                        help="look for missing files in the music folders")
+    parser.add_argument('--discover', choices=['db', 'disk'],
+                        help="print likely new transforms and exit")
+    parser.add_argument('--min-support', type=int, default=3,
+                        help="files needed to propose a transform")
+    args = parser.parse_args()
+
+    if args.discover:
+        for (old_prefix, new_prefix), count in discover(
+                mixxxdb.open_readonly(), args.discover):
+            if count >= args.min_support:
+                print("# %d files" % count)
+                print("%s -> %s" % (old_prefix, new_prefix))
+        return
+
+    trie = PrefixTrie(load_transforms(args.transforms))
+
+    db = mixxxdb.open_copy()
+
+    logger.info("finding matching locations")
+    locations = dict(db.execute('''
+      SELECT location, id FROM track_locations
+      WHERE location IS NOT NULL
+    '''))
+    moves = []
+    for location, id in locations.items():
+        if not trie.rewrites(location):
+            continue
+        new_location = resolve(trie, locations, location)
+        if new_location:
+            logger.info("moving from %s to %s", location, new_location)
+            moves.append((id, locations[new_location]))
+        elif not pathlib.Path(location).exists():
+            logger.info("no replacement for: %s", location)
+
+    logger.info("fixing %d matching locations", len(moves))
+    db.execute('''
+      CREATE TEMP TABLE repath_map (
+        old_id INTEGER PRIMARY KEY,
+        new_id INTEGER NOT NULL
+      )
+    ''')
+    db.executemany('''
+      INSERT INTO repath_map (old_id, new_id) VALUES (?, ?)
+    ''', moves)
+    db.execute('''
+      UPDATE library SET location=m.new_id
+      FROM repath_map m
+      WHERE library.location = m.old_id
+    ''')
+    db.execute('''
+      DELETE FROM track_analysis
+      WHERE track_id IN (SELECT old_id FROM repath_map)
+    ''')
+    db.execute('''
+      DELETE FROM track_locations
+      WHERE id IN (SELECT old_id FROM repath_map)
+    ''')
+
+    if args.find_moved:
+        fsindex.scan(fsindex.open_index())
+        fsindex.apply_moved(db, fsindex.find_moved(db))
 
     logger.info("commiting")
     db.commit()
@@ -17,112 +17,103 @@
 # properly before, as it wasn't giving priority to versions with
 # playlists... even though theoretically it was updting the playlists
 # as well!
+#
+# The backup can be a data-base file, or the name or date of a snapshot
+# taken with snapshots.py, which is then rebuilt next to the others.
 
 import os.path
 import re
 import sys
-import shutil
 import pathlib
 import logging
-import sqlite3
+
+import mixxxdb
+import snapshots
 
 logger = logging.getLogger(__name__)
 
-def restore_file(db, tid):
-    row = db.execute('''
-      SELECT *
-      FROM library
-      WHERE id=?
-    ''', (tid,)).fetchone()
-    if row != None:
-        return # track is there
-
-    logger.info("restoring: %s", tid)
-
-    row = db.execute('''
-      SELECT *
-      FROM backup.library
-      WHERE id=?
-    ''', (tid,)).fetchone()
-
-    # copy and fetch from library, assume new version has at least all
-    # the attrs that the old version has
-    db.execute('''
-      INSERT INTO library(''' + ", ".join(row.keys()) + ''')
-      SELECT ''' + ", ".join(row.keys()) + ''' FROM backup.library
-      WHERE id=?
-    ''', (tid,))
-    location, artist, title, bpm = db.execute('''
-      SELECT location, artist, title, bpm
-      FROM library
-      WHERE id=?
-    ''', (tid,)).fetchone()
-
-    # copy and fetch location
+
+def restore_tracks(db):
+    """Restore all missing playlist tracks from the backup at once.
+
+    The tracks to restore are found with a single anti-join, and every
+    table is then restored with one statement over that set of ids.
+    """
     db.execute('''
-      INSERT INTO track_locations
+      CREATE TEMP TABLE restore_ids AS
+      SELECT DISTINCT pt.track_id AS id
+      FROM PlaylistTracks pt
+      JOIN Playlists p ON p.id = pt.playlist_id
+      LEFT JOIN library l ON l.id = pt.track_id
+      WHERE p.hidden = 0 AND l.id IS NULL
+    ''')
+    unknown = db.execute('''
+      DELETE FROM restore_ids
+      WHERE id NOT IN (SELECT id FROM backup.library)
+      RETURNING id
+    ''').fetchall()
+    if unknown:
+        logger.warning("not in the backup either: %s",
+                       ", ".join(str(tid) for tid, in unknown))
+
+    # copy from library, assume new version has at least all the attrs
+    # that the old version has
+    columns = ", ".join(
+        column for _, column, *_ in db.execute('''
+          PRAGMA backup.table_info(library)
+        '''))
+    counts = {}
+    counts['library'] = db.execute('''
+      INSERT INTO library(''' + columns + ''')
+      SELECT ''' + columns + ''' FROM backup.library
+      WHERE id IN (SELECT id FROM restore_ids)
+    ''').rowcount
+    counts['track_locations'] = db.execute('''
+      INSERT OR IGNORE INTO track_locations
       SELECT * FROM backup.track_locations
-      WHERE id=?
-    ''', (location,))
-    path_str, = db.execute('''
-      SELECT location
-      FROM track_locations
-      WHERE id=?
-    ''', (location,)).fetchone()
-
+      WHERE id IN (SELECT location FROM library
+                   WHERE id IN (SELECT id FROM restore_ids))
+    ''').rowcount
     # copy a bunch of other things
-    db.execute('''
+    counts['track_analysis'] = db.execute('''
       REPLACE INTO track_analysis
       SELECT * FROM backup.track_analysis
-      WHERE track_id=?
-    ''', (tid,))
-    db.execute('''
+      WHERE track_id IN (SELECT id FROM restore_ids)
+    ''').rowcount
+    counts['cues'] = db.execute('''
       REPLACE INTO cues
       SELECT * FROM backup.cues
-      WHERE track_id=?
-    ''', (tid,))
-
-    logger.info("restored: %s", path_str)
-
-
-def restore_playlist(db, pid, name):
-    tracks = db.execute('''
-      SELECT track_id, position
-      FROM PlaylistTracks
-      WHERE playlist_id=?
-      ORDER BY position
-    ''', (pid,))
-    logger.info("relocating playlist: %s", name)
-
-    for tid, tpos in tracks:
-        restore_file(db, tid)
+      WHERE track_id IN (SELECT id FROM restore_ids)
+    ''').rowcount
+
+    for path_str, in db.execute('''
+      SELECT tl.location
+      FROM restore_ids r
+      JOIN library l ON l.id = r.id
+      JOIN track_locations tl ON tl.id = l.location
+    '''):
+        logger.debug("restored: %s", path_str)
+    for table, count in counts.items():
+        logger.info("restored %d rows in %s", count, table)
 
 def main():
     if len(sys.argv) != 2:
-        logger.warning("need to pass a backup file")
+        logger.warning("need to pass a backup file or snapshot")
         return
 
     logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 
-    logger.info("copying database")
-    shutil.copyfile('./mixxxdb.sqlite',
-                    './mixxxdb.fixed.sqlite')
+    backup = sys.argv[1]
+    if not os.path.exists(backup):
+        backup = snapshots.restore(backup, snapshots.TARGET)
 
-    db = sqlite3.connect('mixxxdb.fixed.sqlite')
-    db.row_factory = sqlite3.Row
+    db = mixxxdb.open_copy()
 
     db.execute('''
       ATTACH DATABASE ? AS backup
-    ''', (sys.argv[1],))
-
-    playlists = db.execute('''
-      SELECT id, name
-      FROM Playlists
-      WHERE hidden = 0
-    ''')
+    ''', (backup,))
 
-    for pid, name in playlists:
-        restore_playlist(db, pid, name)
+    restore_tracks(db)
 
     logger.info("committing")
     db.commit()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2018 Juan Pedro Bolivar Puente
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the MIT License, as detailed in the LICENSE
+# file located at the root of this source code distribution,
+# or here: <https://github.com/arximboldi/lager/blob/master/LICENSE>
+#
+
+# snapshots.py
+# ------------
+#
+# Incremental backups of the Mixxx data-base.
+#
+# Instead of keeping a full copy of the data-base for every backup, the
+# data-base is split in its SQLite pages, and every page is stored
+# compressed under the hash of its contents.  A snapshot is just the
+# list of hashes of its pages, so a new snapshot only takes the space
+# of the pages that changed since any other snapshot.
+#
+# Usage:
+#
+#   snapshots.py save [DATABASE]        store a snapshot, named by time
+#   snapshots.py list                   list the stored snapshots
+#   snapshots.py restore NAME [TARGET]  rebuild a snapshot into TARGET
+#
+# Snapshots can be referred to by their full name or by a date, like
+# 2026-10-18, which picks the last snapshot taken that day.  They are
+# restored to `mixxxdb.snapshot.sqlite` unless a TARGET is given, never
+# over the data-base of Mixxx.
+
+import os
+import re
+import sys
+import json
+import zlib
+import logging
+import hashlib
+import pathlib
+import datetime
+
+import mixxxdb
+
+logger = logging.getLogger(__name__)
+
+STORE = pathlib.Path('./snapshots')
+
+# Where snapshots are rebuilt by default
+TARGET = './mixxxdb.snapshot.sqlite'
+
+date_regex = re.compile(r'\d{4}-\d{2}-\d{2}$')
+
+def page_file(store, digest):
+    return store / 'pages' / digest[:2] / digest
+
+def snapshot_file(store, name):
+    return store / 'snapshots' / (name + '.json')
+
+def names(store=STORE):
+    return sorted(f.stem for f in (store / 'snapshots').glob('*.json'))
+
+def save(database=mixxxdb.SOURCE, store=STORE, name=None):
+    """Store a snapshot of the data-base, returning its name.
+
+    The data-base is read through SQLite, so the snapshot is consistent
+    even if Mixxx is running.
+    """
+    db = mixxxdb.open_readonly(database)
+    data = db.serialize()
+    db.close()
+    page_size = int.from_bytes(data[16:18], 'big')
+    if page_size == 1:
+        page_size = 65536
+
+    pages = []
+    new_pages = new_bytes = 0
+    for offset in range(0, len(data), page_size):
+        page = data[offset:offset + page_size]
+        digest = hashlib.blake2b(page, digest_size=16).hexdigest()
+        pages.append(digest)
+        path = page_file(store, digest)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            compressed = zlib.compress(page)
+            tmp_path = path.with_suffix('.tmp')
+            tmp_path.write_bytes(compressed)
+            os.replace(tmp_path, path)
+            new_pages += 1
+            new_bytes += len(compressed)
+
+    if name is None:
+        name = base = datetime.datetime.now().strftime('%Y-%m-%d-%H%M%S')
+        i = 0
+        while snapshot_file(store, name).exists():
+            i += 1
+            name = '%s-%d' % (base, i)
+    path = snapshot_file(store, name)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # never replace an existing snapshot
+    with open(path, 'x') as f:
+        json.dump({
+            'database': str(database),
+            'created': datetime.datetime.now().isoformat(),
+            'page_size': page_size,
+            'pages': pages,
+        }, f)
+    logger.info("saved snapshot %s: %d pages, %d new (%.1f MB)",
+                name, len(pages), new_pages, new_bytes / 2**20)
+    return name
+
+def find(name, store=STORE):
+    """Full name of the snapshot called name, or of the last snapshot of
+    the day name, if name is a date."""
+    available = names(store)
+    if name in available:
+        return name
+    # names start with the date, but a partial one like 2026-10-1 would
+    # also match other days
+    matches = ([n for n in available if n.startswith(name + '-')]
+               if date_regex.match(name) else [])
+    if not matches:
+        raise KeyError("no snapshot for: %s" % name)
+    return matches[-1]
+
+def restore(name, target=TARGET, store=STORE):
+    """Rebuild the snapshot called name into the file target."""
+    name = find(name, store)
+    with open(snapshot_file(store, name)) as f:
+        snapshot = json.load(f)
+    tmp_target = pathlib.Path(str(target) + '.tmp')
+    with open(tmp_target, 'wb') as f:
+        for digest in snapshot['pages']:
+            f.write(zlib.decompress(page_file(store, digest).read_bytes()))
+    os.replace(tmp_target, target)
+    logger.info("restored snapshot %s into: %s", name, target)
+    return target
+
+def main():
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    command, args = sys.argv[1] if len(sys.argv) > 1 else None, sys.argv[2:]
+    if command == 'save' and len(args) <= 1:
+        print(save(*args))
+    elif command == 'list' and not args:
+        for name in names():
+            print(name)
+    elif command == 'restore' and 1 <= len(args) <= 2:
+        restore(*args)
+    else:
+        logger.warning("usage: snapshots.py save [DATABASE] | list"
+                       " | restore NAME [TARGET]")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2018 Juan Pedro Bolivar Puente
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the MIT License, as detailed in the LICENSE
+# file located at the root of this source code distribution,
+# or here: <https://github.com/arximboldi/lager/blob/master/LICENSE>
+#
+
+# synthdb.py
+# ----------
+#
+# Generates a synthetic Mixxx library to try and benchmark the other
+# scripts without touching the real one, see benchmark.py.
+#
+# A folder is filled with:
+#
+#   mixxxdb.sqlite   the library, with the tables of Mixxx the scripts use
+#   backup.sqlite    the library before some playlist tracks went missing,
+#                    for restore-playlists.py
+#   repath.conf      a transform for the moved files, for repath.py
+#   music/           tiny audio files of a fraction of a second
+#   moved/           files that were moved away from music/
+#   playlists/       playlists as exported by Rekordbox, for reimport.py
+#
+# The library has the usual problems the scripts fix: duplicates that
+# share a location, or the same audio, or that are different versions of
+# the same song, missing files, moved files, orphan rows, and duplicate
+# cues.  Everything is random, but always the same for the same seed.
+
+import io
+import sys
+import wave
+import shutil
+import random
+import logging
+import pathlib
+import sqlite3
+import argparse
+
+from export import export_filename
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+  CREATE TABLE track_locations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    location varchar(512) UNIQUE,
+    filename varchar(512),
+    directory varchar(512),
+    filesize INTEGER,
+    fs_deleted INTEGER,
+    needs_verification INTEGER
+  );
+  CREATE TABLE library (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    artist varchar(64),
+    title varchar(64),
+    album varchar(64),
+    year varchar(16),
+    genre varchar(64),
+    tracknumber varchar(3),
+    location integer REFERENCES track_locations(location),
+    comment varchar(256),
+    duration integer,
+    bitrate integer,
+    samplerate integer,
+    cuepoint integer,
+    bpm float,
+    channels integer,
+    datetime_added DEFAULT CURRENT_TIMESTAMP,
+    mixxx_deleted integer DEFAULT 0,
+    played integer DEFAULT 0,
+    filetype varchar(8) DEFAULT '?',
+    timesplayed integer DEFAULT 0,
+    rating integer DEFAULT 0,
+    key varchar(8) DEFAULT ''
+  );
+  CREATE TABLE Playlists (
+    id INTEGER PRIMARY KEY,
+    name varchar(48),
+    position INTEGER,
+    hidden INTEGER DEFAULT 0 NOT NULL,
+    date_created datetime,
+    date_modified datetime,
+    locked INTEGER DEFAULT 0
+  );
+  CREATE TABLE PlaylistTracks (
+    id INTEGER PRIMARY KEY,
+    playlist_id INTEGER REFERENCES Playlists(id),
+    track_id INTEGER REFERENCES library(id),
+    position INTEGER,
+    pl_datetime_added TEXT
+  );
+  CREATE TABLE crates (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name varchar(48) UNIQUE NOT NULL,
+    count INTEGER DEFAULT 0,
+    show INTEGER DEFAULT 1,
+    locked INTEGER DEFAULT 0,
+    autodj_source INTEGER DEFAULT 0
+  );
+  CREATE TABLE crate_tracks (
+    crate_id INTEGER NOT NULL REFERENCES crates(id),
+    track_id INTEGER NOT NULL REFERENCES library(id),
+    UNIQUE (crate_id, track_id)
+  );
+  CREATE TABLE cues (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    track_id INTEGER NOT NULL REFERENCES library(id),
+    type INTEGER DEFAULT 0 NOT NULL,
+    position INTEGER DEFAULT -1 NOT NULL,
+    length INTEGER DEFAULT 0 NOT NULL,
+    hotcue INTEGER DEFAULT -1 NOT NULL,
+    label TEXT DEFAULT '' NOT NULL,
+    color INTEGER DEFAULT 4294901760 NOT NULL
+  );
+  CREATE TABLE track_analysis (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    track_id INTEGER NOT NULL REFERENCES library(id),
+    type varchar(512),
+    description varchar(1024),
+    version varchar(512),
+    created DATETIME,
+    data_checksum varchar(512)
+  );
+'''
+
+GENRES = ['techno', 'house', 'dub', 'jazz', 'cumbia', 'rumba', 'funk']
+KEYS = ['Am', 'C', 'Em', 'G', 'Bm', 'D', 'F#m', 'A', 'Dm', 'F']
+FILETYPES = [('mp3', 320, 44100), ('flac', 1411, 44100), ('ogg', 192, 48000)]
+
+# Files per directory in music/
+DIR_SIZE = 100
+
+def audio(rng, frames):
+    """A tiny WAV file of noise, so that every file is different."""
+    data = io.BytesIO()
+    with wave.open(data, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(1)
+        f.setframerate(8000)
+        f.writeframes(rng.randbytes(frames))
+    return data.getvalue()
+
+class Generator:
+    """Builds the rows of the library one track at a time.
+
+    Files are written as soon as their location is added, so only the
+    rows are kept in memory.
+    """
+    def __init__(self, root, seed):
+        self.root = root.absolute()
+        self.rng = random.Random(seed)
+        self.locations = []
+        self.tracks = []
+        self.files = 0
+
+    def add_location(self, path, content):
+        """Add a track location for path, writing content to its file, or
+        leaving it missing when content is None."""
+        lid = len(self.locations) + 1
+        size = len(content) if content is not None else self.rng.randrange(
+            1000, 10000)
+        deleted = int(content is None and self.rng.random() < 0.5)
+        self.locations.append((lid, str(path), path.name, str(path.parent),
+                               size, deleted, 0))
+        if content is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(content)
+            self.files += 1
+        return lid
+
+    def add_track(self, lid, artist, title, duration, bpm):
+        """Add a library row for the track location lid."""
+        tid = len(self.tracks) + 1
+        rng = self.rng
+        filetype, bitrate, samplerate = FILETYPES[tid % len(FILETYPES)]
+        self.tracks.append({
+            'id': tid,
+            'artist': artist,
+            'title': title,
+            'album': 'Album %d' % (tid // 12),
+            'year': str(1960 + tid % 60),
+            'genre': GENRES[tid % len(GENRES)],
+            'tracknumber': str(tid % 12 + 1),
+            'location': lid,
+            'duration': duration,
+            'bitrate': bitrate,
+            'samplerate': samplerate,
+            'cuepoint': rng.randrange(0, 44100 * 10),
+            'bpm': bpm,
+            'channels': 2,
+            'timesplayed': rng.randrange(0, 30),
+            'rating': rng.randrange(0, 6),
+            'filetype': filetype,
+            'key': KEYS[tid % len(KEYS)],
+        })
+        return tid
+
+def remove(root):
+    """Remove the library generated in the folder root, refusing to
+    remove any other folder."""
+    root = pathlib.Path(root)
+    if root.exists():
+        if any(root.iterdir()) and not (root / 'backup.sqlite').exists():
+            raise FileExistsError("not a generated library: %s" % root)
+        shutil.rmtree(root)
+
+def generate(root, tracks=1000, seed=0, missing=0.05, moved=0.03,
+             duplicates=0.05):
+    """Generate a library of about tracks tracks in the folder root.
+
+    missing, moved and duplicates are the fraction of tracks whose file
+    is missing, was moved, and that have a duplicate of each kind.
+    """
+    root = pathlib.Path(root)
+    remove(root)
+    root.mkdir(parents=True)
+    gen = Generator(root, seed)
+    rng = gen.rng
+    music = gen.root / 'music'
+    moved_music = gen.root / 'moved'
+
+    logger.info("generating %d tracks", tracks)
+    artists = max(1, tracks // 10)
+    originals = []
+    for i in range(tracks):
+        artist = 'Artist %d' % rng.randrange(artists)
+        title = 'Title %d' % i
+        filetype = FILETYPES[(i + 1) % len(FILETYPES)][0]
+        path = music / ('%03d' % (i // DIR_SIZE)) / (
+            '%s - %s.%s' % (artist, title, filetype))
+        content = audio(rng, rng.randrange(200, 2000))
+        duration = rng.randrange(120, 600)
+        bpm = round(rng.uniform(80, 160), 2)
+        luck = rng.random()
+        # the file with the audio of the track, if any, is read again
+        # for the duplicates instead of keeping every file in memory
+        if luck < missing:
+            lid = gen.add_location(path, None)
+            source = None
+        elif luck < missing + moved:
+            lid = gen.add_location(path, None)
+            source = moved_music / path.relative_to(music)
+            gen.add_location(source, content)
+        else:
+            lid = gen.add_location(path, content)
+            source = path
+        tid = gen.add_track(lid, artist, title, duration, bpm)
+        originals.append((tid, lid, path, source, artist, title,
+                          duration, bpm))
+
+    logger.info("adding duplicates")
+    count = int(len(originals) * duplicates)
+    for tid, lid, path, source, artist, title, duration, bpm in rng.sample(
+            originals, count):
+        # same location, as left behind by Mixxx
+        gen.add_track(lid, artist, title, duration, bpm)
+    for tid, lid, path, source, artist, title, duration, bpm in rng.sample(
+            originals, count):
+        # same audio in another file
+        if source is not None:
+            copy = path.with_name(path.stem + ' (copy)' + path.suffix)
+            gen.add_track(gen.add_location(copy, source.read_bytes()),
+                          artist, title, duration, bpm)
+    for tid, lid, path, source, artist, title, duration, bpm in rng.sample(
+            originals, count):
+        # another version of the song
+        other = path.with_name(path.stem + ' (remaster).mp3')
+        gen.add_track(gen.add_location(other, audio(rng, 500)),
+                      artist.upper(), title + ' (Remastered)',
+                      duration + rng.choice([-1, 0, 1]), bpm)
+
+    logger.info("writing data-base")
+    db = sqlite3.connect(root / 'mixxxdb.sqlite')
+    db.execute('PRAGMA journal_mode=OFF')
+    db.execute('PRAGMA synchronous=OFF')
+    db.executescript(SCHEMA)
+    db.executemany('''
+      INSERT INTO track_locations
+        (id, location, filename, directory, filesize, fs_deleted,
+         needs_verification)
+      VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', gen.locations)
+    columns = list(gen.tracks[0])
+    db.executemany('''
+      INSERT INTO library (%s) VALUES (%s)
+    ''' % (', '.join(columns), ', '.join('?' * len(columns))),
+                   [[track[c] for c in columns] for track in gen.tracks])
+
+    tids = [track['id'] for track in gen.tracks]
+    cues = []
+    for tid in tids:
+        for hotcue in range(rng.randrange(0, 8)):
+            cues.append((tid, 1, rng.randrange(0, 44100 * 300), 0, hotcue))
+        if rng.random() < duplicates and cues:
+            cues.append(cues[-1])
+    db.executemany('''
+      INSERT INTO cues (track_id, type, position, length, hotcue)
+      VALUES (?, ?, ?, ?, ?)
+    ''', cues)
+    analysis = [(tid, 'waveform', 'Waveform', 'GaborWaveform5.0', 'x' * 256)
+                for tid in tids]
+    # analysis of tracks that were removed
+    analysis += [(len(tids) + i + 1, 'waveform', 'Waveform',
+                  'GaborWaveform5.0', 'x' * 256)
+                 for i in range(int(len(tids) * duplicates))]
+    db.executemany('''
+      INSERT INTO track_analysis
+        (track_id, type, description, version, data_checksum)
+      VALUES (?, ?, ?, ?, ?)
+    ''', analysis)
+
+    playlists = {}
+    for pid in range(1, max(1, len(tids) // 200) + 1):
+        playlists[pid] = rng.sample(tids, min(len(tids), rng.randrange(20, 100)))
+    db.executemany('''
+      INSERT INTO Playlists
+        (id, name, position, hidden, date_created, date_modified)
+      VALUES (?, ?, ?, ?, '2018-01-01', '2018-01-01')
+    ''', [(pid, 'Playlist %d' % pid, pid, int(pid % 10 == 0))
+          for pid in playlists])
+    db.executemany('''
+      INSERT INTO PlaylistTracks (playlist_id, track_id, position)
+      VALUES (?, ?, ?)
+    ''', [(pid, tid, position)
+          for pid, entries in playlists.items()
+          for position, tid in enumerate(entries, 1)])
+    crates = range(1, max(1, len(tids) // 500) + 1)
+    db.executemany('''
+      INSERT INTO crates (id, name) VALUES (?, ?)
+    ''', [(cid, 'Crate %d' % cid) for cid in crates])
+    db.executemany('''
+      INSERT INTO crate_tracks (crate_id, track_id) VALUES (?, ?)
+    ''', [(cid, tid)
+          for cid in crates
+          for tid in rng.sample(tids, min(len(tids), rng.randrange(10, 50)))])
+    db.commit()
+
+    logger.info("removing some playlist tracks after the backup")
+    db.execute('VACUUM INTO ?', (str(root / 'backup.sqlite'),))
+    used = sorted({tid for entries in playlists.values() for tid in entries})
+    lost = rng.sample(used, max(1, int(len(used) * missing)))
+    db.executemany('''
+      DELETE FROM library WHERE id=?
+    ''', [(tid,) for tid in lost])
+    db.commit()
+    db.close()
+
+    with open(root / 'repath.conf', 'w') as f:
+        f.write('%s -> %s\n' % (music, moved_music))
+
+    logger.info("writing playlists")
+    (root / 'playlists').mkdir()
+    by_id = {track['id']: track for track in gen.tracks}
+    for pid, entries in playlists.items():
+        with open(root / 'playlists' / ('Playlist %d.m3u8' % pid), 'w') as f:
+            f.write('#EXTM3U\n')
+            for tid in entries:
+                track = by_id[tid]
+                name = export_filename(tid, track['artist'], track['title'],
+                                       track['bpm'], '.mp3')
+                if rng.random() < duplicates:
+                    # renamed by hand
+                    name = 'renamed %d.mp3' % tid
+                f.write('#EXTINF:%d,%s - %s\n' % (
+                    track['duration'], track['artist'], track['title']))
+                f.write('/Volumes/USB/Contents/%s\n' % name)
+
+    logger.info("generated %d tracks, %d locations, %d files",
+                len(gen.tracks), len(gen.locations), gen.files)
+
+def main():
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('folder', type=pathlib.Path,
+                        help="folder for the library, replaced if it has one")
+    parser.add_argument('-n', '--tracks', type=int, default=1000,
+                        help="number of tracks, before duplicates")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate(args.folder, args.tracks, args.seed)
+
+if __name__ == '__main__':
+    main()